@@ -0,0 +1,99 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import aiohttp
+
+from rcon import get_breaker
+
+CHUNK_LENGTH = timedelta(hours=6) # Length of the time windows logs are fetched in
+CHUNK_CONCURRENCY = 4 # Max number of windows being fetched at once
+CHUNK_RETRIES = 3 # Number of times fetching a window is retried before giving up
+CHUNK_RETRY_DELAY = 2 # Seconds before the first retry, doubled with every next one
+LOG_OVERLAP = timedelta(minutes=2) # How far back incremental fetches start before the newest log already seen, for rows that are stored late
+
+# Only errors that may go away by trying again. A wrong URL or credentials won't.
+RETRY_ON = (asyncio.TimeoutError, aiohttp.ClientError)
+
+
+def split_window(since, until, length=CHUNK_LENGTH):
+    """Split [since, until) into windows of at most length. The last window
+    is left open when until is None."""
+    windows = list()
+    end = until or datetime.utcnow()
+    while since + length < end:
+        windows.append((since, since + length))
+        since += length
+    windows.append((since, until))
+    return windows
+
+
+def _event_time(log):
+    return datetime.fromisoformat(log['event_time'])
+
+async def _stream_window(session, method, endpoint, payload, since_keys, start, end, timeout, retries):
+    """Yield the logs of a single window as they are downloaded. Retried only
+    until the first log is yielded, and not once the host is considered down."""
+    payload = dict(payload)
+    for key in since_keys:
+        payload[key] = str(start)
+    if end: payload['till'] = str(end)
+    else: payload.pop('till', None)
+    kwargs = {'json': payload} if method == 'POST' else {'params': payload}
+    if timeout: kwargs['timeout'] = timeout
+
+    for attempt in range(retries + 1):
+        yielded = False
+        try:
+            async for log in session.stream(method, endpoint, **kwargs):
+                yielded = True
+                yield log
+            return
+        except RETRY_ON as e:
+            if yielded or attempt == retries or get_breaker(session.url).open:
+                raise
+            print('Failed to fetch logs from %s to %s, retrying: %s: %s' % (start, end, e.__class__.__name__, e))
+            await asyncio.sleep(CHUNK_RETRY_DELAY * 2**attempt)
+
+async def _fetch_window(session, method, endpoint, payload, since_keys, start, end, timeout, retries):
+    """Fetch a window that is followed by others, in timestamp order."""
+    logs = list()
+    async for log in _stream_window(session, method, endpoint, payload, since_keys, start, end, timeout, retries):
+        # Both ends are inclusive, so leave the rows at the end to the next window
+        if _event_time(log) < end:
+            logs.append(log)
+    logs.sort(key=lambda log: (log['event_time'], log['id']))
+    return logs
+
+
+async def fetch_logs(session, method, endpoint, payload, since, until=None, timeout=None, since_keys=('from',),
+        length=CHUNK_LENGTH, concurrency=CHUNK_CONCURRENCY, retries=CHUNK_RETRIES):
+    """Fetch the logs between since and until, or up until now when until is
+    None, by splitting the range into windows that are fetched concurrently.
+    The payload's since_keys and "till" are filled in per window. Windows are
+    yielded in order, each sorted by timestamp, except for the last one,
+    which is streamed as it comes in. A range that fits in a single window
+    is thus streamed in one request."""
+    *windows, (last_start, last_end) = split_window(since, until, length)
+    windows = iter(windows)
+    tasks = list()
+
+    def schedule():
+        for start, end in windows:
+            tasks.append(asyncio.ensure_future(_fetch_window(session, method, endpoint, payload, since_keys, start, end, timeout, retries)))
+            return
+
+    try:
+        # Keep a few windows ahead of the one being yielded, but not all of them
+        for _ in range(concurrency):
+            schedule()
+        while tasks:
+            logs = await tasks.pop(0)
+            schedule()
+            for log in logs:
+                yield log
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    async for log in _stream_window(session, method, endpoint, payload, since_keys, last_start, last_end, timeout, retries):
+        yield log
@@ -1,18 +1,36 @@
 import discord
 from discord.ext import commands, tasks
-import aiohttp
 import asyncio
 import math
-from datetime import datetime
+import json
+import time
+from datetime import datetime, timezone
 
-from models import DBConnection
+from models import db
+import rcon
+import feeds
+import killstore
+import scheduler
 
 EMOJIS = ['1️⃣', '2️⃣', '3️⃣', '4️⃣', '5️⃣', '6️⃣', '7️⃣', '8️⃣', '9️⃣', '🔟']
+PAGE_BUTTON_ID = 'scoreboard:page:'
+PAGING_MODE = 'buttons' # Either 'buttons', 'ephemeral' or 'reactions'
 EMBED_ICON = 'https://media.discordapp.net/attachments/729998051288285256/791030109628399647/MiP_-5ea_400x400.png'
 
-LOGIN_ENDPOINT = 'login'
-MAP_HISTORY_ENDPOINT = 'get_map_history'
-GET_LOGS_ENDPOINT = 'get_historical_logs'
+UPDATE_CONCURRENCY = 20 # Max number of scoreboards updating at the same time
+UPDATE_TIMEOUT = 30 # Max number of seconds a single scoreboard may take to update
+REGISTER_CONCURRENCY = 25 # Max number of scoreboards being registered at the same time
+
+POLL_TICK = 10 # Seconds between checking which scoreboards are due for an update
+BUSY_KILL_RATE = 20 # Kills per minute from which a match counts as busy
+BUSY_INTERVAL = 30 # Seconds between updates during a busy match
+DEFAULT_INTERVAL = 60 # Seconds between updates during a match with some kills
+IDLE_INTERVAL = 180 # Seconds between updates while nobody is getting killed
+ENDED_INTERVAL = 300 # Seconds between updates while showing a match that has ended
+PROBE_INTERVAL = 60 # Seconds between checking for a new match on RCONs of slowed down scoreboards
+AUDIENCE_TIMEOUT = 6 * 3600 # Seconds without anyone interacting after which a scoreboard is considered unwatched
+UNWATCHED_INTERVAL = 900 # Min number of seconds between updates of unwatched scoreboards
+STATS_INTERVAL = 3600 # Seconds between logging how many message edits were sent and skipped
 
 ASCII_ART = """`                    __________                     
               _____/          \______              
@@ -30,39 +48,11 @@ ASCII_ART = """`                    __________
              |______________________||             
                                                   `"""
 
-MAPS = {
-    "foy_warfare": "Foy",
-    "stmariedumont_warfare": "SMDM",
-    "hurtgenforest_warfare": "Hurtgen",
-    "hurtgenforest_warfare_V2": "Hurtgen",
-    "utahbeach_warfare": "Utah",
-    "omahabeach_offensive_us": "Off. Omaha",
-    "stmereeglise_warfare": "SME",
-    "stmereeglise_offensive_ger": "Off. SME (Ger)",
-    "foy_offensive_ger": "Off. Foy",
-    "purpleheartlane_warfare": "PHL",
-    "purpleheartlane_offensive_us": "Off. PHL",
-    "hill400_warfare": "Hill 400",
-    "hill400_offensive_US": "Off. Hill 400",
-    "stmereeglise_offensive_us": "Off. SME (US)",
-    "carentan_warfare": "Carentan",
-    "carentan_offensive_us": "Off. Carentan",
-    "hurtgenforest_offensive_ger": "Off. Hurtgen (Ger)",
-    "hurtgenforest_offensive_US": "Off. Hurtgen (US)",
-    "utahbeach_offensive_us": "Off. Utah (US)",
-    "utahbeach_offensive_ger": "Off. Utah (GER)",
-}
-
-class VerificationError(Exception):
-    pass
-class RCONError(Exception):
-    pass
-class ContentTypeError(Exception):
-    pass
-
 class ScoreboardInstance:
     @classmethod
-    async def create(cls, bot, name, guild_id, channel_id, message_id, api_url, api_user, api_pw, scoreboard_url, server_id):
+    async def create(cls, bot, name, guild_id, channel_id, message_id, api_url, api_user, api_pw, scoreboard_url, server_id, lazy=False):
+        """Create a scoreboard instance. When lazy, an existing message isn't
+        fetched until the first update."""
         self = ScoreboardInstance()
 
         self.bot = bot
@@ -75,165 +65,255 @@ class ScoreboardInstance:
         self.guild = self.bot.get_guild(int(guild_id))
         self.channel = self.guild.get_channel(int(channel_id))
         self._message_id = int(message_id)
-        try: self.message = await self.channel.fetch_message(self._message_id)
-        except discord.NotFound:
-            await self._resend_message()
+        self.registry = None
+        if lazy and self._message_id:
+            self.message = self.channel.get_partial_message(self._message_id)
+            self._reactions = set()
+            self._message_stale = True
+        else:
+            await self._refresh_message()
 
         #await self.message.clear_reactions()
         self.page = 1
+        self.interval = DEFAULT_INTERVAL
+        self.next_update = 0
+        self.last_seen = time.monotonic()
+        self._feed = None
+        self._pages = dict()
+        self._pages_key = None
+        self._last_render = None
+        self._unreachable_shown = False
+        self.edits_sent = 0
+        self.edits_skipped = 0
         return self
+
+    async def _refresh_message(self):
+        """Fetch the message over REST, or send a new one if it is gone. Only
+        needed when the cached message can't be trusted anymore, gateway
+        events keep it up to date otherwise."""
+        try: self.message = await self.channel.fetch_message(self._message_id)
+        except discord.NotFound:
+            await self._resend_message()
+        else:
+            self._reactions = {str(reaction.emoji) for reaction in self.message.reactions if reaction.me}
+            self._message_stale = False
+
     async def _resend_message(self):
         self.message = await self.channel.send(embed=discord.Embed(description='No! Don\'t look yet!'))
+        self._reactions = set()
+        self._message_stale = False
+        self._last_render = None
         if self._message_id:
-            with DBConnection('data.db') as cur:
-                cur.execute('UPDATE scoreboards SET message_id = ? WHERE channel_id = ? AND name = ? AND api_url = ? AND server_id = ?',
-                    (self.message.id, self.channel.id, self.name, self.url, self.server_filter))
+            await db.execute('UPDATE scoreboards SET message_id = ? WHERE channel_id = ? AND name = ? AND api_url = ? AND server_id = ?',
+                (self.message.id, self.channel.id, self.name, self.url, self.server_filter))
         else:
-            self.add_to_database()
+            await self.add_to_database()
         self._message_id = self.message.id
+        if self.registry: self.registry.reindex(self)
 
     async def update(self):
+        # Back off in case we get cancelled halfway, an update that hangs
+        # shouldn't be retried on every tick
+        self.next_update = time.monotonic() + self.interval
         try:
-            try: self.message = await self.channel.fetch_message(self._message_id)
-            except discord.NotFound: await self._resend_message()
+            if self._message_stale: await self._refresh_message()
             await self._fetch_data()
             await self._update_embed()
+            self.interval = self.poll_interval()
+            self._unreachable_shown = False
         except Exception as e:
-            try: await self.display_message(f'Failed to update scoreboard:\n{e.__class__.__name__}: {str(e)}\n\nContact an admin if this keeps occuring.')
+            breaker = rcon.get_breaker(self.url)
+            self.interval = DEFAULT_INTERVAL
+            self.next_update = max(time.monotonic() + self.interval, breaker.retry_at)
+            try:
+                if isinstance(e, rcon.RCONUnavailable) or breaker.open:
+                    # Other scoreboards may have been the ones to find out, so
+                    # show it if this one hasn't yet, and leave it up after that
+                    if not self._unreachable_shown:
+                        await self.display_message(f'The RCON can not be reached:\n{e.__class__.__name__}: {str(e)}\n\nThe scoreboard will be updated again once it is back online.')
+                        self._unreachable_shown = True
+                else:
+                    await self.display_message(f'Failed to update scoreboard:\n{e.__class__.__name__}: {str(e)}\n\nContact an admin if this keeps occuring.')
+                    self._unreachable_shown = False
             except Exception as e2: print('UpdateError:', e2.__class__.__name__ + ': ' + str(e2))
             raise e
-        
-    async def _fetch_data(self):
-        # Get logs
-        jar = aiohttp.CookieJar(unsafe=True)
-        timeout = aiohttp.ClientTimeout(total=10)
-        async with aiohttp.ClientSession(cookie_jar=jar, timeout=timeout) as session:
+        self.next_update = time.monotonic() + self.interval
 
-            try:
-                # Login
-                payload = {'username': self.username, 'password': self.password}
-                async with session.post(self.url+LOGIN_ENDPOINT, json=payload) as res:
-                    raw_data = await res.json()
-                    if raw_data['error']:
-                        raise RCONError(raw_data['error'])
-                    failed = raw_data['failed']
-                    if failed is True:
-                        raise VerificationError('Failed to login to the RCON. Check if the username and password are correct.')
-                
-                # Get match history
-                async with session.get(self.url+MAP_HISTORY_ENDPOINT) as res:
-                    raw_data = await res.json()
-                    if raw_data['error']:
-                        raise RCONError(raw_data['error'])
-                    match_history = raw_data['result']
-                    
-                    match_info = match_history[0]
-                    match_start_ts = match_info['start']
-                    self.match_end = None
-
-                    self.match_start = datetime.utcfromtimestamp(match_start_ts)
-                    if (datetime.utcnow() - self.match_start).total_seconds() < 300:
-                        match_info = match_history[1]
-                        match_start_ts = match_info['start']
-                        self.match_start = datetime.utcfromtimestamp(match_start_ts)
-                        match_end_ts = match_info['end']
-                        self.match_end = datetime.utcfromtimestamp(match_end_ts)
-
-                    current_map = match_info['name'].replace('_RESTART', '')
-                    try: self.current_map = MAPS[current_map]
-                    except KeyError: self.current_map = current_map
-                
-                # Get logs
-                payload = {'limit': 999999, 'log_type': 'KILL', 'action': 'KILL', 'from': str(self.match_start), 'from_': str(self.match_start), 'server_filter': self.server_filter}
-                if self.match_end: payload['till'] = str(self.match_end)
-                async with session.get(self.url+GET_LOGS_ENDPOINT, params=payload) as res:
-                    raw_data = await res.json()
-                    if raw_data['error']:
-                        raise RCONError(raw_data['error'])
-                    logs = raw_data['result']
-
-            except aiohttp.ContentTypeError as e:
-                raise ContentTypeError("Webpage returned unexpected data. Likely the URL is incorrect.\n\nRaw data:\n" + str(e))
-            except asyncio.TimeoutError as e:
-                e.args = 'Could not resolve host within 10 seconds. Check if the URL is correct and the RCON tool is running.', 
+    def poll_interval(self):
+        """Seconds until this scoreboard should be updated again, based on
+        the state of the match it displays."""
+        if self.match_end:
+            interval = ENDED_INTERVAL
+            # Update right when the new match takes over
+            switch_in = self._feed.match_state.new_match_displayed_in()
+            if switch_in is not None: interval = min(interval, switch_in + 1)
+        elif self._feed.kill_rate >= BUSY_KILL_RATE:
+            interval = BUSY_INTERVAL
+        elif self._feed.kill_rate > 0:
+            interval = DEFAULT_INTERVAL
+        else:
+            interval = IDLE_INTERVAL
+        if not self.watched:
+            interval = max(interval, UNWATCHED_INTERVAL)
+        return interval
+
+    @property
+    def watched(self):
+        return time.monotonic() - self.last_seen < AUDIENCE_TIMEOUT
+
+    def mark_seen(self):
+        """Register that someone is looking at this scoreboard, bringing it
+        back up to speed if it was considered unwatched."""
+        if not self.watched:
+            self.next_update = 0
+        self.last_seen = time.monotonic()
         
-        # Parse logs
-        data = dict()
-        for log in logs:
-            killer = log['player_name'] if 'player_name' in log else log['player1_name']
-            victim = log['player2_name']
-
-            if log['type'] == 'KILL':
-                # Kills
-                try: data[killer][0] += 1
-                except KeyError: data[killer] = [1, 0]
-            # Deaths
-            try: data[victim][1] += 1
-            except KeyError: data[victim] = [0, 1]
-        data = dict(sorted(data.items(), key=lambda item: item[1][0]*1000-item[1][1], reverse=True))
-        self._data = data
+    async def _fetch_data(self):
+        # Log in with our own credentials, even when another scoreboard
+        # already fetched the data we're about to use
+        session = rcon.get_session(self.url, self.username, self.password)
+        await session.login()
+
+        feed = feeds.get_feed(self.url, self.server_filter)
+        await feed.refresh(session)
+        self._feed = feed
+        self.match_start = feed.match_start
+        self.match_end = feed.match_end
+        self.current_map = feed.current_map
+        self._data = feed.data
+
+    def _render_pages(self):
+        """Render all pages of the current data at once. The result is reused
+        until the data or anything else that is displayed changes."""
+        match_duration = int((datetime.utcnow() - self.match_start).total_seconds() / 60)
+        show_art = not self._data and match_duration >= 15 and match_duration <= 30
+        key = (self._data, self.match_start, self.match_end, self.current_map, self.name, self.scoreboard_url, show_art)
+        if self._pages_key == key:
+            return self._pages
 
-    async def _update_embed(self):
         # Get number of pages
         total_pages = math.ceil(len(self._data)/30)
-        _from = ((self.page - 1) * 30) + 1
-        _to = self.page * 30
-        # Does current page overflow?
-        if 0 < total_pages < self.page:
-            self.page = total_pages
-
-        # Turn data into arrays
-        data = [
-            (i+1, k, v[0], v[1], round(v[0]/v[1], 2) if v[1] else 0.00)
-            for i, (k, v) in enumerate(self._data.items())
-            if i+1 >= _from and i+1 <= _to
-        ]
-
-        # Add empty rows
-        if len(data) < 30:
-            data = data + [('', '', '', '', '')]*(30-len(data))
-
-        # Write output
-        output = "RANK  NAME                      KILLS  DEATHS K/D   "
-        for rank, name, kills, deaths, kd in data:
-            output += "\n#{: <4} {: <25} {: <6} {: <6} {: <6}".format(rank, name.replace('`', ''), kills, deaths, kd)
-        output = "`" + output + "`"
-
-        # Create embed
-        match_duration = int((datetime.utcnow() - self.match_start).total_seconds() / 60)
-        embed = discord.Embed(description=output)
-        if not self._data:
-            # Cool ASCII art when no data
-            if match_duration >= 15 and match_duration <= 30:
-                embed.description = ASCII_ART.format(self.name[:21])
+        ranks = self._data.top(0, min(total_pages, len(EMOJIS))*30)
+
+        self._pages = dict()
+        for page in range(1, max(1, min(total_pages, len(EMOJIS)))+1):
+
+            # Turn data into arrays
+            data = [
+                (rank, name, kills, deaths, round(kills/deaths, 2) if deaths else 0.00)
+                for rank, name, kills, deaths in ranks[(page-1)*30:page*30]
+            ]
+
+            # Add empty rows
+            if len(data) < 30:
+                data = data + [('', '', '', '', '')]*(30-len(data))
+
+            # Write output
+            output = "RANK  NAME                      KILLS  DEATHS K/D   "
+            for rank, name, kills, deaths, kd in data:
+                output += "\n#{: <4} {: <25} {: <6} {: <6} {: <6}".format(rank, name.replace('`', ''), kills, deaths, kd)
+            output = "`" + output + "`"
+
+            # Create embed
+            embed = discord.Embed(description=output)
+            if not self._data:
+                # Cool ASCII art when no data
+                if show_art:
+                    embed.description = ASCII_ART.format(self.name[:21])
+                else:
+                    embed.description = "`{: <51}\n{: <51}\n{: <51}`".format('','        There is no data to be displayed :(','')
+            # Discord renders these timestamps relative to now by itself, which
+            # keeps the embed the same from one minute to the next
+            if self.match_end:
+                match_length = int((self.match_end - self.match_start).total_seconds() / 60)
+                match_ended = discord.utils.format_dt(self.match_end.replace(tzinfo=timezone.utc), 'R')
+                embed.description += f"\nMatch ended {match_ended}. It lasted {match_length} minutes. Map was {self.current_map}."
             else:
-                embed.description = "`{: <51}\n{: <51}\n{: <51}`".format('','        There is no data to be displayed :(','')
-        if self.scoreboard_url: embed.description += f'\n[\> Click here for more stats]({self.scoreboard_url})'
-        embed.set_author(icon_url=EMBED_ICON, name=self.name)
+                match_started = discord.utils.format_dt(self.match_start.replace(tzinfo=timezone.utc), 'R')
+                embed.description += f"\nMatch started {match_started}. Map is {self.current_map}."
+            if self.scoreboard_url: embed.description += f'\n[\> Click here for more stats]({self.scoreboard_url})'
+            embed.set_author(icon_url=EMBED_ICON, name=self.name)
+
+            # Set embed footer
+            if PAGING_MODE == 'reactions':
+                embed.set_footer(text=f"Page {str(page)}/{str(total_pages)} - react below to cycle pages.")
+            elif PAGING_MODE == 'ephemeral' and page > 1:
+                embed.set_footer(text=f"Page {str(page)}/{str(total_pages)} - only you can see this page.")
+            else:
+                embed.set_footer(text=f"Page {str(page)}/{str(total_pages)} - use the buttons below to cycle pages.")
+            self._pages[page] = embed
 
-        # Set embed footer
-        if self.match_end:
-            match_ended = int((datetime.utcnow() - self.match_end).total_seconds() / 60)
-            match_length = int((self.match_end - self.match_start).total_seconds() / 60)
-            embed.set_footer(text=f"Match ended {match_ended} minutes ago. It lasted {match_length} minutes. Map was {self.current_map}.\nPage {str(self.page)}/{str(total_pages)} - react below to cycle pages.")
-        else:
-            embed.set_footer(text=f"Match started {match_duration} minutes ago. Map is {self.current_map}.\nPage {str(self.page)}/{str(total_pages)} - react below to cycle pages.")
+        self._pages_key = key
+        return self._pages
+
+    async def _update_embed(self):
+        pages = self._render_pages()
+        # Does current page overflow?
+        if PAGING_MODE == 'ephemeral':
+            self.page = 1
+        elif self.page > len(pages):
+            self.page = len(pages)
+        embed = pages[self.page]
         
         # Update embed
         try:
-            await self.message.edit(embed=embed)
+            await self._edit(embed)
         except:
             print("Failed to update scoreboard:")
             print(embed.description)
-            embed.description = "Failed to update the scoreboard\nCome back later"
-            await self.message.edit(embed=discord.Embed())
+            # The rendered page is shared, so don't modify it
+            await self._edit(discord.Embed(description="Failed to update the scoreboard\nCome back later"))
 
         # Update reactions
+        if PAGING_MODE != 'reactions':
+            # Reactions left over from before switching to buttons
+            if self._reactions:
+                # Needs Manage Messages, which isn't worth failing the update over
+                try: await self.message.clear_reactions()
+                except discord.HTTPException as e: print('Unable to clear reactions from %s: %s' % (self.name, e))
+                self._reactions.clear()
+            return
+        total_pages = len(pages) if self._data else 0
         for i, emoji in enumerate(EMOJIS):
-            if i+1 <= total_pages and emoji not in [str(reaction) for reaction in self.message.reactions]:
+            if i+1 <= total_pages and emoji not in self._reactions:
                 await self.message.add_reaction(emoji)
-            elif i+1 > total_pages and emoji in [str(reaction) for reaction in self.message.reactions]:
+                self._reactions.add(emoji)
+            elif i+1 > total_pages and emoji in self._reactions:
                 await self.message.clear_reaction(emoji)
+                self._reactions.discard(emoji)
+
+    def _page_view(self):
+        """Buttons to switch between the rendered pages, if there's more than one."""
+        if len(self._pages) < 2:
+            return None
+        view = discord.ui.View(timeout=None)
+        for page in self._pages:
+            # Everyone gets their own copy of a page in ephemeral mode, so
+            # there is no current page to highlight
+            current = page == self.page and PAGING_MODE != 'ephemeral'
+            view.add_item(discord.ui.Button(
+                label=str(page),
+                custom_id=PAGE_BUTTON_ID + str(page),
+                style=discord.ButtonStyle.primary if current else discord.ButtonStyle.secondary,
+                disabled=current
+            ))
+        return view
+
+    async def show_page(self, page, interaction=None):
+        """Switch to another page, using the already rendered pages. When
+        switched through a button, the interaction is responded to. In
+        ephemeral mode that response is the page itself, visible only to
+        the user who clicked, and the public message is left alone."""
+        pages = self._render_pages()
+        if interaction and PAGING_MODE == 'ephemeral':
+            if page in pages: await interaction.response.send_message(embed=pages[page], ephemeral=True)
+            else: await interaction.response.defer()
+            return
+        if page not in pages or page == self.page:
+            if interaction: await interaction.response.defer()
+            return
+        self.page = page
+        await self._edit(pages[page], interaction=interaction, priority=scheduler.PRIORITY_USER)
 
     async def display_message(self, message):
         lines = list()
@@ -265,32 +345,84 @@ class ScoreboardInstance:
         embed.set_author(icon_url=EMBED_ICON, name=self.name)
        
         # Update embed
-        await self.message.edit(embed=embed)
-
-    def add_to_database(self):
-        with DBConnection('data.db') as cur:
-            cur.execute('INSERT INTO scoreboards VALUES (?,?,?,?,?,?,?,?,?)', (self.name, self.guild.id, self.channel.id,
-                self.message.id, self.url, self.username, self.password, self.scoreboard_url, self.server_filter))
+        await self._edit(embed, paged=False)
+
+    async def _edit(self, embed, paged=True, interaction=None, priority=scheduler.PRIORITY_BACKGROUND):
+        """Edit the message, unless it already shows this exact embed.
+        Returns whether an edit was made."""
+        kwargs = dict(embed=embed)
+        if PAGING_MODE != 'reactions':
+            kwargs['view'] = self._page_view() if paged else None
+
+        fingerprint = hash(json.dumps(embed.to_dict(), sort_keys=True))
+        if self._last_render == (self.page, paged, fingerprint):
+            self.edits_skipped += 1
+            if interaction: await interaction.response.defer()
+            return False
+        if interaction:
+            await interaction.response.edit_message(**kwargs)
+            # A background refresh that is still queued would put the old page back
+            scheduler.get_scheduler().cancel(self.message.id)
+        else:
+            edits = scheduler.get_scheduler()
+            try:
+                applied = await edits.edit(self.message, priority=priority, **kwargs)
+            except discord.NotFound:
+                # Deleted without us seeing the event
+                await self._resend_message()
+                applied = await edits.edit(self.message, priority=priority, **kwargs)
+            if not applied:
+                return False # Replaced by a newer edit before it was sent
+        self._last_render = (self.page, paged, fingerprint)
+        self.edits_sent += 1
+        return True
+
+    def invalidate_message(self):
+        self._message_stale = True
+    def on_reaction_add(self, emoji):
+        self._reactions.add(str(emoji))
+    def on_reaction_remove(self, emoji):
+        self._reactions.discard(str(emoji))
+    def on_reaction_clear(self, emoji=None):
+        if emoji: self._reactions.discard(str(emoji))
+        else: self._reactions.clear()
+
+    async def add_to_database(self):
+        await db.execute('INSERT INTO scoreboards VALUES (?,?,?,?,?,?,?,?,?)', (self.name, self.guild.id, self.channel.id,
+            self.message.id, self.url, self.username, self.password, self.scoreboard_url, self.server_filter))
 
     async def delete(self):
-        with DBConnection('data.db') as cur:
-            cur.execute('DELETE FROM scoreboards WHERE message_id = ?', (self.message.id,))
+        await db.execute('DELETE FROM scoreboards WHERE message_id = ?', (self.message.id,))
         await self.message.delete()
         self = None
 
-    def save(self):
-        with DBConnection('data.db') as cur:
-            cur.execute('''UPDATE scoreboards SET name = ?, guild_id = ?, channel_id = ?, message_id = ?,
-                api_url = ?, api_user = ?, api_pw = ?, scoreboard_url = ?, server_id = ? WHERE message_id = ?''', (
-                    self.name, self.guild.id, self.channel.id, self.message.id, self.url, self.username,
-                    self.password, self.scoreboard_url, self.server_filter, self._message_id))
+    async def save(self):
+        await db.execute('''UPDATE scoreboards SET name = ?, guild_id = ?, channel_id = ?, message_id = ?,
+            api_url = ?, api_user = ?, api_pw = ?, scoreboard_url = ?, server_id = ? WHERE message_id = ?''', (
+                self.name, self.guild.id, self.channel.id, self.message.id, self.url, self.username,
+                self.password, self.scoreboard_url, self.server_filter, self._message_id))
+        if self.message.id != self._message_id:
+            # Replaced by a new message, which shows none of what we rendered before
+            self._last_render = None
+            self._reactions = set()
+            self._message_stale = False
         self._message_id = self.message.id
+        if self.registry: self.registry.reindex(self)
 
 from collections.abc import Sequence
 
 class ScoreboardList(Sequence):
-    def __init__(self, initial_value: list = []):
-        self.scoreboards = initial_value
+    def __init__(self, initial_value: list = None):
+        self.scoreboards = list()
+        self._by_message = dict()
+        self._by_guild = dict()
+        self._by_channel = dict()
+        self._keys = dict()
+        self._updating = dict()
+        self._probing = None
+        self._semaphore = asyncio.Semaphore(UPDATE_CONCURRENCY)
+        for instance in initial_value or []:
+            self.add(instance)
         super().__init__()
 
     def __getitem__(self, i):
@@ -298,8 +430,30 @@ class ScoreboardList(Sequence):
     def __len__(self):
         return len(self.scoreboards)
 
+    def _index(self, instance: ScoreboardInstance):
+        keys = (instance.message.id, instance.guild.id, instance.channel.id)
+        self._keys[id(instance)] = keys
+        self._by_message[keys[0]] = instance
+        self._by_guild.setdefault(keys[1], dict())[keys[0]] = instance
+        self._by_channel.setdefault(keys[2], dict())[keys[0]] = instance
+
+    def _unindex(self, instance: ScoreboardInstance):
+        message_id, guild_id, channel_id = self._keys.pop(id(instance))
+        self._by_message.pop(message_id, None)
+        for index, key in ((self._by_guild, guild_id), (self._by_channel, channel_id)):
+            index[key].pop(message_id, None)
+            if not index[key]:
+                del index[key]
+
+    def reindex(self, instance: ScoreboardInstance):
+        """Update the indexes after the instance's message or channel changed."""
+        self._unindex(instance)
+        self._index(instance)
+
     def add(self, instance: ScoreboardInstance):
         self.scoreboards.append(instance)
+        self._index(instance)
+        instance.registry = self
         return self.scoreboards
 
     async def register(self, *args, **kwargs):
@@ -308,86 +462,225 @@ class ScoreboardList(Sequence):
         return instance
     
     async def delete(self, message_id: int):
-        for i, sb in enumerate(self.scoreboards):
-            if sb.message.id == int(message_id):
-                await sb.delete()
-                self.scoreboards[i] = None
-                return
-        raise KeyError('No scoreboard found with this message_id')
+        sb = self.get(message_id)
+        if not sb:
+            raise KeyError('No scoreboard found with this message_id')
+        self._unindex(sb)
+        self.scoreboards.remove(sb)
+        sb.registry = None
+        await sb.delete()
     
-    async def update_all(self, silent=True):
-        for inst in self.scoreboards:
+    async def _update(self, inst, semaphore, timeout):
+        """Update a single scoreboard. Returns None or the exception it failed with."""
+        async with semaphore:
             try:
-                if inst: await inst.update()
+                await asyncio.wait_for(inst.update(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return asyncio.TimeoutError('Update took longer than %s seconds' % timeout)
             except Exception as e:
-                if not silent:
-                    print('%s - Failed to update %s:\n%s' % (datetime.now(), inst.name, e))
-        
-    def get(self, message_id: int, return_index=False):
-        result = None
-        index = None
-        for i, sb in enumerate(self):
-            if not sb:
+                return e
+
+    def _report(self, inst, e):
+        if e is not None and not isinstance(e, rcon.RCONUnavailable):
+            print('%s - Failed to update %s:\n%s: %s' % (datetime.now(), inst.name, e.__class__.__name__, e))
+
+    async def update_all(self, silent=True, concurrency=UPDATE_CONCURRENCY, timeout=UPDATE_TIMEOUT):
+        """Update all scoreboards concurrently and wait for them. Returns a
+        dict mapping each instance to either None or the exception it failed with."""
+        semaphore = asyncio.Semaphore(concurrency)
+        instances = list(self.scoreboards)
+        errors = await asyncio.gather(*[self._update(inst, semaphore, timeout) for inst in instances])
+        results = dict(zip(instances, errors))
+        if not silent:
+            for inst, e in results.items():
+                self._report(inst, e)
+        return results
+
+    def start_due(self, silent=True, timeout=UPDATE_TIMEOUT):
+        """Start updating the scoreboards whose interval has passed, each in
+        its own task, without waiting for them. Those still updating from
+        before are skipped, so a slow one never holds up the others."""
+        now = time.monotonic()
+        for inst in self.scoreboards:
+            if inst.next_update > now or inst in self._updating:
                 continue
-            elif sb.message.id == int(message_id):
-                result = sb
-                index = i
-                break
-        if return_index: return result, index
-        else: return result
-    
-    def set(self, index, sb):
-        self.scoreboards[index] = sb
+            task = asyncio.ensure_future(self._update(inst, self._semaphore, timeout))
+            self._updating[inst] = task
+            task.add_done_callback(lambda task, inst=inst: self._update_done(inst, task, silent))
+
+    def _update_done(self, inst, task, silent):
+        del self._updating[inst]
+        if not task.cancelled() and not silent:
+            self._report(inst, task.result())
+
+    def start_probe(self, max_age=PROBE_INTERVAL):
+        """Start probing in the background, unless the last probe is still running."""
+        if self._probing is None or self._probing.done():
+            self._probing = asyncio.ensure_future(self.probe(max_age))
+
+    def cancel_updates(self):
+        """Stop the updates and probe that were started in the background."""
+        for task in list(self._updating.values()):
+            task.cancel()
+        if self._probing:
+            self._probing.cancel()
+        
+    async def probe(self, max_age=PROBE_INTERVAL):
+        """Check for new matches on the RCONs of scoreboards that are being
+        updated less often, and update those right away when one started."""
+        probes = dict()
+        for sb in self.scoreboards:
+            if sb._feed and sb.interval > DEFAULT_INTERVAL and sb.watched:
+                probes.setdefault(sb._feed.match_state, list()).append(sb)
+
+        async def _probe(match_state, sbs):
+            before = match_state.history[0]['start']
+            session = rcon.get_session(sbs[0].url, sbs[0].username, sbs[0].password)
+            try: await match_state.revalidate(session, max_age=max_age)
+            except Exception: return # Left for the next update to report
+            if match_state.history[0]['start'] != before:
+                for sb in sbs:
+                    sb.next_update = 0
+
+        await asyncio.gather(*[_probe(match_state, sbs) for match_state, sbs in probes.items()])
+
+    def edit_stats(self):
+        """Returns the total number of message edits sent and skipped."""
+        return sum(sb.edits_sent for sb in self), sum(sb.edits_skipped for sb in self)
+
+    def get(self, message_id: int):
+        return self._by_message.get(int(message_id))
+
+    def by_guild(self, guild_id: int):
+        return list(self._by_guild.get(int(guild_id), dict()).values())
+    def by_channel(self, channel_id: int):
+        return list(self._by_channel.get(int(channel_id), dict()).values())
 
 
 class scoreboard(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        with DBConnection('data.db') as con:
-            con.execute('''CREATE TABLE IF NOT EXISTS scoreboards
-                (name TEXT, guild_id INT, channel_id INT, message_id INT PRIMARY KEY, api_url TEXT, api_user TEXT, api_pw TEXT, scoreboard_url TEXT, server_id INT)''')
+        self.bot.scoreboards = ScoreboardList()
+        self._stats_logged_at = time.monotonic()
+
+    async def cog_load(self):
+        await db.execute('''CREATE TABLE IF NOT EXISTS scoreboards
+            (name TEXT, guild_id INT, channel_id INT, message_id INT PRIMARY KEY, api_url TEXT, api_user TEXT, api_pw TEXT, scoreboard_url TEXT, server_id INT)''')
+        await db.execute('CREATE INDEX IF NOT EXISTS scoreboards_guild_id ON scoreboards (guild_id)')
+        await db.execute('CREATE INDEX IF NOT EXISTS scoreboards_channel_id ON scoreboards (channel_id)')
+        await killstore.create_tables()
+
+    async def cog_unload(self):
+        self.update_scoreboard.cancel()
+        self.bot.scoreboards.cancel_updates()
+        scheduler.get_scheduler().close()
+        await rcon.close_all()
+        await db.flush()
 
     @commands.Cog.listener()
     async def on_ready(self):
+        if self.update_scoreboard.is_running():
+            # Reconnected, we may have missed events about our messages
+            for sb in self.bot.scoreboards:
+                sb.invalidate_message()
+            return
         
-        with DBConnection('data.db') as cur:
-            cur.execute('SELECT * FROM scoreboards')
-            res = cur.fetchall()
+        res = await db.fetchall('SELECT * FROM scoreboards')
 
+        # Start updating right away, scoreboards are picked up as they get registered
         self.bot.scoreboards = ScoreboardList()
-        for row in res:
-            try: await self.bot.scoreboards.register(self.bot, *row)
-            except Exception as e:
-                print('Unable to register %s - %s: %s' % (row[0], e.__class__.__name__, e))
-        
-        print('Launched at', datetime.now())     
         self.update_scoreboard.add_exception_type(Exception)
         self.update_scoreboard.start()
 
+        semaphore = asyncio.Semaphore(REGISTER_CONCURRENCY)
+        async def register(row):
+            async with semaphore:
+                try: await self.bot.scoreboards.register(self.bot, *row, lazy=True)
+                except Exception as e:
+                    print('Unable to register %s - %s: %s' % (row[0], e.__class__.__name__, e))
+        await asyncio.gather(*[register(row) for row in res])
+        
+        print('Launched at', datetime.now())     
 
-    @tasks.loop(minutes=1)
+
+    @tasks.loop(seconds=POLL_TICK)
     async def update_scoreboard(self):
-        await self.bot.scoreboards.update_all(silent=False)
+        # Neither is waited for, so one slow RCON can't hold back the next tick
+        self.bot.scoreboards.start_probe()
+        self.bot.scoreboards.start_due(silent=False)
+
+        if time.monotonic() - self._stats_logged_at >= STATS_INTERVAL:
+            self._stats_logged_at = time.monotonic()
+            sent, skipped = self.bot.scoreboards.edit_stats()
+            print('%s - Scoreboard edits: %s sent, %s skipped as unchanged, %s replaced before sending' % (
+                datetime.now(), sent, skipped, scheduler.get_scheduler().edits_coalesced))
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload):
-        for scoreboard in self.bot.scoreboards:
-            if not scoreboard:
-                continue
-            if payload.message_id == scoreboard.message.id and payload.user_id != self.bot.user.id:
-                if str(payload.emoji) in EMOJIS:
-                    new_page = EMOJIS.index(str(payload.emoji))+1
-                    if scoreboard.page != new_page:
-                        scoreboard.page = new_page
-                        await scoreboard._update_embed()
-                await scoreboard.message.remove_reaction(str(payload.emoji), payload.member)
+        scoreboard = self.bot.scoreboards.get(payload.message_id)
+        if not scoreboard:
+            return
+        if payload.user_id == self.bot.user.id:
+            scoreboard.on_reaction_add(payload.emoji)
+            return
+        scoreboard.mark_seen()
+        if str(payload.emoji) in EMOJIS:
+            new_page = EMOJIS.index(str(payload.emoji))+1
+            await scoreboard.show_page(new_page)
+        await scoreboard.message.remove_reaction(str(payload.emoji), payload.member)
+
+    @commands.Cog.listener()
+    async def on_interaction(self, interaction):
+        custom_id = (interaction.data or dict()).get('custom_id', '')
+        if interaction.type != discord.InteractionType.component or not custom_id.startswith(PAGE_BUTTON_ID):
+            return
+        scoreboard = self.bot.scoreboards.get(interaction.message.id)
+        if scoreboard:
+            scoreboard.mark_seen()
+            await scoreboard.show_page(int(custom_id[len(PAGE_BUTTON_ID):]), interaction=interaction)
+        else:
+            await interaction.response.defer()
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        # People chatting in the channel are likely to look at its scoreboards
+        if message.author.bot:
+            return
+        for scoreboard in self.bot.scoreboards.by_channel(message.channel.id):
+            scoreboard.mark_seen()
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload):
+        scoreboard = self.bot.scoreboards.get(payload.message_id)
+        if scoreboard and payload.user_id == self.bot.user.id:
+            scoreboard.on_reaction_remove(payload.emoji)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear(self, payload):
+        scoreboard = self.bot.scoreboards.get(payload.message_id)
+        if scoreboard: scoreboard.on_reaction_clear()
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_clear_emoji(self, payload):
+        scoreboard = self.bot.scoreboards.get(payload.message_id)
+        if scoreboard: scoreboard.on_reaction_clear(payload.emoji)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        scoreboard = self.bot.scoreboards.get(payload.message_id)
+        if scoreboard: scoreboard.invalidate_message()
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload):
+        for message_id in payload.message_ids:
+            scoreboard = self.bot.scoreboards.get(message_id)
+            if scoreboard: scoreboard.invalidate_message()
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild):
-        for i, sb in enumerate(self.bot.scoreboards):
-            if sb.guild.id == guild.id:
-                await sb.delete()
-                self.scoreboards[i] = None
+        for sb in self.bot.scoreboards.by_guild(guild.id):
+            try: await self.bot.scoreboards.delete(sb.message.id)
+            except discord.HTTPException: pass # We can't delete messages in guilds we're no longer in
 
 
         
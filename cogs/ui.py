@@ -1,12 +1,38 @@
-from datetime import timedelta
+from datetime import datetime, timedelta
 from urllib.parse import urlparse
 
+import aiohttp
 import discord
 from discord.ext import commands
 from utils import ask_message, ask_reaction
-import aiohttp
+import rcon
+import killstore
 import asyncio
 
+WINDOW_UNITS = {'h': timedelta(hours=1), 'd': timedelta(days=1), 'w': timedelta(weeks=1)}
+LEADERBOARD_SIZE = 15 # Number of players shown by the leaderboard command
+LOGS_TIMEOUT = aiohttp.ClientTimeout(total=300) # Backfilling a leaderboard's window can take a while to download
+
+
+def parse_window(window):
+    """Parse a leaderboard window, either a duration like "24h", "7d" or "2w",
+    or a date range like "2021-03-01 2021-03-16". Returns (since, until)."""
+    parts = window.split()
+    try:
+        if len(parts) == 1 and parts[0][-1:].lower() in WINDOW_UNITS:
+            until = datetime.utcnow()
+            since = until - int(parts[0][:-1]) * WINDOW_UNITS[parts[0][-1].lower()]
+        elif len(parts) in (1, 2):
+            since = datetime.fromisoformat(parts[0])
+            until = datetime.fromisoformat(parts[1]) if len(parts) == 2 else datetime.utcnow()
+        else:
+            since = until = None
+        if since and since < until:
+            return since, until
+    except (ValueError, OverflowError):
+        pass
+    raise commands.BadArgument('%s isn\'t a valid window. Use a duration like 24h, 7d or 2w, or a date range like 2021-03-01 2021-03-16' % window)
+
 
 class ui(commands.Cog):
     def __init__(self, bot):
@@ -16,7 +42,7 @@ class ui(commands.Cog):
     @commands.command(name='list', aliases=['scoreboards', 'sbs', 'list_scoreboards'])
     async def list_scoreboards(self, ctx):
         embed = discord.Embed()
-        sbs = [sb for sb in self.bot.scoreboards if sb.guild.id == ctx.guild.id]
+        sbs = self.bot.scoreboards.by_guild(ctx.guild.id)
         
         if sbs:
             
@@ -105,20 +131,20 @@ class ui(commands.Cog):
             url = url._replace(query='')
             url = url._replace(fragment='')
             api_url = url.geturl()
+            # Don't keep a pooled session around for URLs that may be mistyped
+            session = rcon.RCONSession(api_url)
             try:
-                jar = aiohttp.CookieJar(unsafe=True)
-                timeout = aiohttp.ClientTimeout(total=10)
-                async with aiohttp.ClientSession(cookie_jar=jar, timeout=timeout) as session:
-                    async with session.get(api_url+'public_info') as res:
-                        res = (await res.json())['result']
-            except aiohttp.ContentTypeError as e:
-                error = f'Webpage returned unexpected data. Likely the URL used ({api_url}) is incorrect.', None
+                res = (await session.get('public_info'))['result']
+            except rcon.ContentTypeError as e:
+                return f'Webpage returned unexpected data. Likely the URL used ({api_url}) is incorrect.', None
             except asyncio.TimeoutError as e:
-                error = f'Could not resolve host within 10 seconds. Check if the URL is correct ({api_url}) and the RCON tool is running.', None
+                return f'Could not resolve host within {rcon.REQUEST_TIMEOUT} seconds. Check if the URL is correct ({api_url}) and the RCON tool is running.', None
             except KeyError:
                 return 'Connected, but received unexpected data', None
             except Exception as e:
                 return e.__class__.__name__ + ": " + str(e), None
+            finally:
+                await session.close()
             return None, api_url
         error, api_url = await validate_api_url(api_url)
         while error is not None:
@@ -255,17 +281,17 @@ class ui(commands.Cog):
         await ctx.send(embed=embed)
         await scoreboard.update()
 
-    async def get_scoreboard(self, ctx, message, return_index=False):
+    async def get_scoreboard(self, ctx, message):
         try: message = int(message)
         except ValueError:
             try: message = (await commands.MessageConverter().convert(ctx, message)).id
             except commands.BadArgument:
                 raise commands.BadArgument('Message could not be found')
         
-        sb, i = ctx.bot.scoreboards.get(message, return_index=True)
+        sb = ctx.bot.scoreboards.get(message)
         if not sb or sb.guild.id != ctx.guild.id:
             raise commands.BadArgument('No scoreboard found with message id %s' % message)
-        return (sb, i) if return_index else sb
+        return sb
 
     @commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
     @commands.command(name='delete', aliases=['delete_sb', 'delete_scoreboard', 'remove', 'remove_sb', 'remove_scoreboard'])
@@ -281,7 +307,7 @@ class ui(commands.Cog):
         res = await ask_reaction(ctx, embed, options)
         
         if res == "<:yes:809149148356018256>":
-            await ctx.bot.scoreboards.delete(message)
+            await ctx.bot.scoreboards.delete(sb.message.id)
             embed = discord.Embed(color=discord.Color(7844437))
             embed.set_author(name=f"Scoreboard deleted", icon_url="https://cdn.discordapp.com/emojis/809149148356018256.png")
             await ctx.send(embed=embed)
@@ -289,7 +315,7 @@ class ui(commands.Cog):
     @commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
     @commands.group(name='set', aliases=['edit', 'update', 'set_scoreboard', 'edit_scoreboard', 'update_scoreboard'], invoke_without_command=False)
     async def set_scoreboard(self, ctx, message, option: str):
-        sb, sb_index = await self.get_scoreboard(ctx, message, return_index=True)
+        sb = await self.get_scoreboard(ctx, message)
         option = option.lower()
 
         if option in ['name']:
@@ -331,12 +357,44 @@ class ui(commands.Cog):
         if not value:
             return
 
-        sb.save()
-        ctx.bot.scoreboards.set(sb_index, sb)
+        # Indexes are updated by save(), positions in the list may have
+        # shifted while we were waiting for answers
+        await sb.save()
         embed = discord.Embed(color=discord.Color(7844437), description=f"New value is {value}")
         embed.set_author(name=f"{option} updated", icon_url="https://cdn.discordapp.com/emojis/809149148356018256.png")
         await ctx.send(embed=embed)
         await sb.update()
 
+    @commands.cooldown(1, 30, commands.BucketType.channel)
+    @commands.command(name='leaderboard', aliases=['lb', 'top'])
+    async def leaderboard(self, ctx, message, *, window: str = '24h'):
+        sb = await self.get_scoreboard(ctx, message)
+        since, until = parse_window(window)
+
+        # Feeds only store the kills of matches they were polling, so fetch the rest of the window first
+        complete = True
+        async with ctx.typing():
+            session = rcon.get_session(sb.url, sb.username, sb.password)
+            try: await killstore.sync(session, sb.url, since, timeout=LOGS_TIMEOUT, server=sb.server_filter, method='GET', since_keys=('from', 'from_'))
+            except Exception as e:
+                print('Failed to sync kills for leaderboard of %s: %s: %s' % (sb.name, e.__class__.__name__, e))
+                complete = False
+            data = await killstore.get_stats(sb.url, since, until, server=sb.server_filter)
+        top = data.top(0, LEADERBOARD_SIZE)
+
+        embed = discord.Embed(title=f"🏆 Leaderboard from {since.strftime('%b %d %H:%M')} to {until.strftime('%b %d %H:%M')} 🏆", color=discord.Color.gold())
+        embed.set_author(name=sb.name)
+        if not complete:
+            embed.set_footer(text="The RCON couldn't be reached, only kills recorded while the scoreboard was running are included.")
+        if not top:
+            embed.description = "No kills were recorded in this period."
+        for i, name, kills, deaths, kd, weapon, weapon_kills in top:
+            if i == 1: rank = "🥇"
+            elif i == 2: rank = "🥈"
+            elif i == 3: rank = "🥉"
+            else: rank = "#"+str(i)
+            embed.add_field(name=f"{rank} {name}", value=f"Kills: {str(kills)}\nDeaths: {str(deaths)}\nK/D Ratio: {str(kd)}\nWeapon: {weapon}({str(weapon_kills)})")
+        await ctx.send(embed=embed)
+
 async def setup(bot):
     await bot.add_cog(ui(bot))
\ No newline at end of file
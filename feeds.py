@@ -0,0 +1,236 @@
+import asyncio
+from datetime import datetime
+
+import backfill
+import killstore
+from stats import PlayerStats
+
+MAP_HISTORY_ENDPOINT = 'get_map_history'
+GET_LOGS_ENDPOINT = 'get_historical_logs'
+
+FEED_MAX_AGE = 15 # Seconds fetched data is reused for before fetching again
+MAP_HISTORY_TTL = 300 # Seconds the map history is trusted for while kills keep coming in
+MAP_HISTORY_QUIET_TTL = 60 # Seconds the map history is trusted for once kills stop coming in
+QUIET_AFTER = 90 # Seconds without new kills after which a round is suspected to have ended
+NEW_MATCH_DELAY = 300 # Seconds the previous match is still displayed for after a new one starts
+
+MAPS = {
+    "foy_warfare": "Foy",
+    "stmariedumont_warfare": "SMDM",
+    "hurtgenforest_warfare": "Hurtgen",
+    "hurtgenforest_warfare_V2": "Hurtgen",
+    "utahbeach_warfare": "Utah",
+    "omahabeach_offensive_us": "Off. Omaha",
+    "stmereeglise_warfare": "SME",
+    "stmereeglise_offensive_ger": "Off. SME (Ger)",
+    "foy_offensive_ger": "Off. Foy",
+    "purpleheartlane_warfare": "PHL",
+    "purpleheartlane_offensive_us": "Off. PHL",
+    "hill400_warfare": "Hill 400",
+    "hill400_offensive_US": "Off. Hill 400",
+    "stmereeglise_offensive_us": "Off. SME (US)",
+    "carentan_warfare": "Carentan",
+    "carentan_offensive_us": "Off. Carentan",
+    "hurtgenforest_offensive_ger": "Off. Hurtgen (Ger)",
+    "hurtgenforest_offensive_US": "Off. Hurtgen (US)",
+    "utahbeach_offensive_us": "Off. Utah (US)",
+    "utahbeach_offensive_ger": "Off. Utah (GER)",
+}
+
+
+class _Coalesced:
+    _task = None
+
+    async def _run_once(self, factory):
+        """Run the coroutine made by factory, or wait for the one that is
+        already running."""
+        if self._task is None:
+            self._task = asyncio.ensure_future(factory())
+            self._task.add_done_callback(self._task_done)
+        # Shielded so that a caller timing out doesn't cancel it for everyone else
+        await asyncio.shield(self._task)
+
+    def _task_done(self, task):
+        self._task = None
+        if not task.cancelled():
+            task.exception() # Mark as retrieved, callers will have gotten it already
+
+
+class MatchState(_Coalesced):
+    """Cached map history of a Community RCON. Calls its listeners with
+    itself whenever a new match is detected."""
+
+    def __init__(self, url):
+        self.url = url
+        self.history = None
+        self.fetched_at = None
+        self.listeners = list()
+
+    def invalidate(self):
+        self.fetched_at = None
+
+    async def revalidate(self, session, max_age=MAP_HISTORY_TTL):
+        if self.fetched_at and (datetime.utcnow() - self.fetched_at).total_seconds() < max_age:
+            return self
+        await self._run_once(lambda: self._fetch(session))
+        return self
+
+    async def _fetch(self, session):
+        raw_data = await session.get(MAP_HISTORY_ENDPOINT)
+        history = raw_data['result']
+
+        changed = self.history and (self.history[0]['start'], self.history[0]['name']) != (history[0]['start'], history[0]['name'])
+        self.history = history
+        self.fetched_at = datetime.utcnow()
+        if changed:
+            for listener in self.listeners:
+                listener(self)
+
+    def current(self):
+        """Returns the start, end and map name of the match that should be
+        displayed. Right after a match starts that is still the previous one."""
+        match_info = self.history[0]
+        match_start_ts = match_info['start']
+        match_end = None
+
+        match_start = datetime.utcfromtimestamp(match_start_ts)
+        if (datetime.utcnow() - match_start).total_seconds() < NEW_MATCH_DELAY:
+            match_info = self.history[1]
+            match_start_ts = match_info['start']
+            match_start = datetime.utcfromtimestamp(match_start_ts)
+            match_end_ts = match_info['end']
+            match_end = datetime.utcfromtimestamp(match_end_ts)
+
+        current_map = match_info['name'].replace('_RESTART', '')
+        current_map = MAPS.get(current_map, current_map)
+        return match_start, match_end, current_map
+
+    def new_match_displayed_in(self):
+        """Returns the number of seconds until the newest match replaces the
+        previous one on scoreboards, or None if it already has."""
+        match_start = datetime.utcfromtimestamp(self.history[0]['start'])
+        seconds = NEW_MATCH_DELAY - (datetime.utcnow() - match_start).total_seconds()
+        return seconds if seconds > 0 else None
+
+
+class ServerFeed(_Coalesced):
+    """Match info and kill tallies of a single server on a Community RCON,
+    shared by all scoreboards that display it."""
+
+    def __init__(self, url, server_id):
+        self.url = url
+        self.server_id = server_id
+        self.match_start = None
+        self.match_end = None
+        self.current_map = None
+        self.data = PlayerStats()
+        self.fetched_at = None
+        self.kill_rate = 0
+        self._last_kill_at = None
+        self._reset_tally(None)
+
+        self.match_state = get_match_state(url)
+        self.match_state.listeners.append(self._on_match_change)
+
+    def _reset_tally(self, match_start):
+        self._tally_match = match_start
+        self._tally = PlayerStats()
+        self._last_log_id = 0
+        self._last_log_time = None
+
+    async def refresh(self, session, max_age=FEED_MAX_AGE):
+        """Fetch new data using the given RCONSession, unless it was already
+        fetched less than max_age seconds ago. Concurrent calls wait for the
+        same request instead of sending their own."""
+        if self.fetched_at and (datetime.utcnow() - self.fetched_at).total_seconds() < max_age:
+            return self
+        await self._run_once(lambda: self._fetch(session))
+        return self
+
+    def _on_match_change(self, match_state):
+        self.fetched_at = None
+        self._last_kill_at = None
+
+    async def _fetch(self, session):
+        # Get match history, more often when it looks like the round is over
+        now = datetime.utcnow()
+        quiet = not self._last_kill_at or (now - self._last_kill_at).total_seconds() > QUIET_AFTER
+        await self.match_state.revalidate(session, max_age=MAP_HISTORY_QUIET_TTL if quiet else MAP_HISTORY_TTL)
+        match_start, match_end, current_map = self.match_state.current()
+
+        # Start counting from scratch when a different match is shown
+        counted_since = self.fetched_at or match_start
+        if self._tally_match != match_start:
+            self._reset_tally(match_start)
+            counted_since = match_start
+
+        # Get logs, only those newer than what we've already counted. Rows can
+        # be stored after others with a later event time, so start a little
+        # earlier and skip what we've seen by id. Long matches are fetched in
+        # windows the first time round. Failures aren't retried here, that
+        # wouldn't fit in a scoreboard's update deadline; the next poll and
+        # the circuit breaker take care of it.
+        since = match_start
+        if self._last_log_time:
+            since = max(datetime.fromisoformat(self._last_log_time) - backfill.LOG_OVERLAP, match_start)
+        payload = {'limit': 999999, 'log_type': 'KILL', 'action': 'KILL', 'server_filter': self.server_id}
+
+        # Parse logs while they're being downloaded
+        data = self._tally
+        last_log_id = self._last_log_id
+        new_logs = list()
+        try:
+            async for log in backfill.fetch_logs(session, 'GET', GET_LOGS_ENDPOINT, payload, since, match_end, since_keys=('from', 'from_'), retries=0):
+                # Skip the rows we already counted
+                if log['id'] <= last_log_id:
+                    continue
+                new_logs.append(log)
+                self._last_log_id = max(self._last_log_id, log['id'])
+                if not self._last_log_time or log['event_time'] > self._last_log_time:
+                    self._last_log_time = log['event_time']
+                self._last_kill_at = now
+
+                killer = log['player_name'] if 'player_name' in log else log['player1_name']
+                victim = log['player2_name']
+
+                if log['type'] == 'KILL':
+                    data.add_kill(killer)
+                data.add_death(victim)
+        finally:
+            # Keep the kills around for leaderboards. Also when the fetch failed
+            # halfway, the rows we counted won't be fetched again.
+            killstore.record(self.url, new_logs, self.server_id)
+
+        # Snapshot the tally, so scoreboards can keep using it while we keep counting.
+        # The snapshot is only replaced when something changed, so that
+        # scoreboards can tell new data apart by its identity.
+        if self._last_log_id != last_log_id or self._tally_match != self.match_start:
+            self.data = data.copy()
+
+        self.match_start = match_start
+        self.match_end = match_end
+        self.current_map = current_map
+        self.kill_rate = len(new_logs) / max((now - counted_since).total_seconds(), 1) * 60
+        self.fetched_at = datetime.utcnow()
+
+
+_match_states = dict()
+
+def get_match_state(url):
+    """Get the shared match state for this RCON, creating it if needed."""
+    try:
+        match_state = _match_states[url]
+    except KeyError:
+        match_state = _match_states[url] = MatchState(url)
+    return match_state
+
+_feeds = dict()
+
+def get_feed(url, server_id):
+    """Get the shared feed for this server, creating it if needed."""
+    key = (url, int(server_id))
+    try:
+        feed = _feeds[key]
+    except KeyError:
+        feed = _feeds[key] = ServerFeed(url, int(server_id))
+    return feed
@@ -0,0 +1,187 @@
+import calendar
+from datetime import datetime
+
+import backfill
+from models import db
+from stats import KillTable
+
+GET_LOGS_ENDPOINT = 'get_historical_logs'
+SYNC_BATCH_SIZE = 1000 # Number of logs that are written to the store at once while syncing
+
+HOUR = 3600
+DAY = 86400
+PERIODS = {'hour': HOUR, 'day': DAY}
+
+
+async def create_tables():
+    # Stores from before kills were kept per server can't be told apart, so
+    # start over. Everything in them can be synced from the RCON again.
+    columns = [column[1] for column in await db.fetchall('PRAGMA table_info(kills)')]
+    if columns and 'server' not in columns:
+        for statement in ('DROP TRIGGER IF EXISTS kills_rollup', 'DROP TABLE IF EXISTS kills',
+                'DROP TABLE IF EXISTS kill_rollups', 'DROP TABLE IF EXISTS kill_sync'):
+            await db.execute(statement)
+    # Sync progress from before it was kept per server and window only means
+    # some logs are fetched again, which are then ignored
+    columns = [column[1] for column in await db.fetchall('PRAGMA table_info(kill_sync)')]
+    if columns and 'first_time' not in columns:
+        await db.execute('DROP TABLE kill_sync')
+
+    await db.execute('''CREATE TABLE IF NOT EXISTS kills
+        (url TEXT, id INT, server INT, event_time INT, type TEXT, killer TEXT, victim TEXT, weapon TEXT, PRIMARY KEY (url, id))''')
+    await db.execute('CREATE INDEX IF NOT EXISTS kills_url_event_time ON kills (url, event_time)')
+    await db.execute('''CREATE TABLE IF NOT EXISTS kill_sync
+        (url TEXT, server INT, first_time TEXT, last_id INT, last_time TEXT, PRIMARY KEY (url, server))''')
+
+    # Kills and deaths per server, player and weapon, in hourly and daily buckets. They
+    # are kept up to date by triggers, so only rows that actually got inserted count.
+    await db.execute('''CREATE TABLE IF NOT EXISTS kill_rollups
+        (url TEXT, server INT, period TEXT, bucket INT, player TEXT, weapon TEXT, kills INT, deaths INT,
+        PRIMARY KEY (url, server, period, bucket, player, weapon))''')
+    if not await db.fetchone("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'kills_rollup'"):
+        for period, seconds in PERIODS.items():
+            await db.execute('''INSERT INTO kill_rollups
+                SELECT url, server, ?, event_time - event_time % ?, player, weapon, sum(kills), sum(deaths) FROM (
+                    SELECT url, server, event_time, killer AS player, weapon, 1 AS kills, 0 AS deaths FROM kills WHERE type = 'KILL'
+                    UNION ALL SELECT url, server, event_time, victim, weapon, 0, 1 FROM kills WHERE type = 'KILL'
+                ) GROUP BY 1, 2, 3, 4, 5, 6''', (period, seconds))
+        await db.execute('''CREATE TRIGGER kills_rollup AFTER INSERT ON kills WHEN NEW.type = 'KILL' BEGIN
+            %s
+        END''' % '\n'.join(f'''
+            INSERT INTO kill_rollups VALUES (NEW.url, NEW.server, '{period}', NEW.event_time - NEW.event_time % {seconds}, NEW.killer, NEW.weapon, 1, 0)
+                ON CONFLICT DO UPDATE SET kills = kills + 1;
+            INSERT INTO kill_rollups VALUES (NEW.url, NEW.server, '{period}', NEW.event_time - NEW.event_time % {seconds}, NEW.victim, NEW.weapon, 0, 1)
+                ON CONFLICT DO UPDATE SET deaths = deaths + 1;''' for period, seconds in PERIODS.items()))
+
+
+def to_timestamp(dt):
+    """Turn a naive datetime into the integer timestamps events are stored with."""
+    return calendar.timegm(dt.timetuple())
+
+def parse_log(url, log, server=None):
+    """Turn a KILL or TEAM KILL log into a row of the kills table. The server
+    is taken from the log, or from server when the log doesn't say, and is 0
+    when neither is known."""
+    killer = log['player_name'] if 'player_name' in log else log['player1_name']
+    weapon = log['content'].split(' with ')[-1]
+    if weapon == "None": weapon = "Tank/Arty"
+    event_time = to_timestamp(datetime.fromisoformat(log['event_time']))
+    server = int(log.get('server') or server or 0)
+    return (url, log['id'], server, event_time, log['type'], killer, log['player2_name'], weapon)
+
+
+def _log_failure(future):
+    if not future.cancelled() and future.exception():
+        e = future.exception()
+        print('Failed to store kill events: %s: %s' % (e.__class__.__name__, e))
+
+def record(url, logs, server=None):
+    """Append kill logs to the store, see parse_log for server. Logs that
+    were stored before are ignored. Does not wait for the write to be committed."""
+    rows = [parse_log(url, log, server) for log in logs]
+    if not rows:
+        return
+    future = db.executemany('INSERT OR IGNORE INTO kills VALUES (?,?,?,?,?,?,?,?)', rows)
+    future.add_done_callback(_log_failure)
+    return future
+
+
+async def _store_logs(session, url, method, payload, since_keys, since, until, timeout, server, last_id=0):
+    """Store the kill logs between since and until with an id above last_id.
+    Returns their number, the highest id and the latest event time among them."""
+    count, new_id, new_time = 0, last_id, None
+    batch = list()
+    writes = list()
+    async for log in backfill.fetch_logs(session, method, GET_LOGS_ENDPOINT, payload, since, until, timeout=timeout, since_keys=since_keys):
+        if log['id'] <= last_id:
+            continue
+        batch.append(log)
+        count += 1
+        new_id = max(new_id, log['id'])
+        if not new_time or datetime.fromisoformat(log['event_time']) > datetime.fromisoformat(new_time):
+            new_time = log['event_time']
+        if len(batch) >= SYNC_BATCH_SIZE:
+            writes.append(record(url, batch, server))
+            batch = list()
+    writes.append(record(url, batch, server))
+
+    # Only move on once everything is stored, so that nothing gets skipped next time
+    for write in writes:
+        if write: await write
+    return count, new_id, new_time
+
+async def sync(session, url, since, timeout=None, server=None, method='POST', since_keys=('from',)):
+    """Store all kill logs the RCON has from since onwards, of all its servers
+    or only the given one. Only the part of that range that wasn't synced
+    before is fetched. Returns the number of logs that were fetched."""
+    key = int(server or 0)
+    count = 0
+    row = await db.fetchone('SELECT first_time, last_id, last_time FROM kill_sync WHERE url = ? AND server = ?', (url, key))
+    first_time, last_id, last_time = (datetime.fromisoformat(row[0]), row[1], row[2]) if row else (since, 0, None)
+    payload = {'limit': 999999, 'log_type': 'KILL'}
+    if server: payload['server_filter'] = server
+
+    # Earlier than anything synced so far. Backfilling can span weeks, so it is fetched in windows.
+    if since < first_time:
+        count, _, _ = await _store_logs(session, url, method, payload, since_keys, since, first_time, timeout, server)
+        first_time = since
+        await db.execute('UPDATE kill_sync SET first_time = ? WHERE url = ? AND server = ?', (str(first_time), url, key))
+
+    # Rows can be stored after others with a later event time, so start a
+    # little earlier and skip what we've seen by id
+    start = datetime.fromisoformat(last_time) - backfill.LOG_OVERLAP if last_time else since
+    new_count, new_id, new_time = await _store_logs(session, url, method, payload, since_keys, start, None, timeout, server, last_id)
+    if not new_time or (last_time and datetime.fromisoformat(new_time) < datetime.fromisoformat(last_time)):
+        new_time = last_time or str(since)
+
+    await db.execute('INSERT OR REPLACE INTO kill_sync VALUES (?,?,?,?,?)', (url, key, str(first_time), new_id, new_time))
+    return count + new_count
+
+
+def _split_window(since, until):
+    """Split [since, until) into as few daily, hourly and raw ranges as
+    possible. Returns {source: [(start, end), ...]}."""
+    ranges = {'day': [], 'hour': [], 'raw': []}
+    first_hour = -(-since // HOUR) * HOUR
+    last_hour = until // HOUR * HOUR
+    if first_hour >= last_hour:
+        ranges['raw'].append((since, until))
+        return ranges
+
+    first_day = -(-first_hour // DAY) * DAY
+    last_day = last_hour // DAY * DAY
+    if first_day < last_day:
+        ranges['day'].append((first_day, last_day))
+        ranges['hour'] += [(first_hour, first_day), (last_day, last_hour)]
+    else:
+        ranges['hour'].append((first_hour, last_hour))
+    ranges['raw'] += [(since, first_hour), (last_hour, until)]
+
+    for source in ranges:
+        ranges[source] = [(start, end) for start, end in ranges[source] if start < end]
+    return ranges
+
+async def get_stats(url, since, until=None, server=None):
+    """Returns a KillTable over the stored kills of this RCON between since
+    and until, of all its servers or only the given one. Whole days and hours
+    are read from the rollups, only the edges of the window from the kills
+    themselves."""
+    since = to_timestamp(since)
+    until = to_timestamp(until) if until else to_timestamp(datetime.utcnow()) + 1
+    server_clause = ' AND server = ?' if server is not None else ''
+    server_params = [int(server)] if server is not None else []
+
+    queries = list()
+    params = list()
+    for source, ranges in _split_window(since, until).items():
+        for start, end in ranges:
+            if source == 'raw':
+                queries.append("SELECT killer AS player, weapon, 1 AS k, 0 AS d FROM kills WHERE url = ? AND type = 'KILL' AND event_time >= ? AND event_time < ?" + server_clause)
+                queries.append("SELECT victim AS player, weapon, 0 AS k, 1 AS d FROM kills WHERE url = ? AND type = 'KILL' AND event_time >= ? AND event_time < ?" + server_clause)
+                params += ([url, start, end] + server_params) * 2
+            else:
+                queries.append("SELECT player, weapon, kills AS k, deaths AS d FROM kill_rollups WHERE url = ? AND period = ? AND bucket >= ? AND bucket < ?" + server_clause)
+                params += [url, source, start, end] + server_params
+
+    rows = await db.fetchall('SELECT player, weapon, sum(k), sum(d) FROM (%s) GROUP BY 1, 2' % ' UNION ALL '.join(queries), params)
+    return KillTable.from_counts(*(zip(*rows) if rows else ([], [], [], [])))
@@ -3,10 +3,22 @@ from discord.ext import commands, tasks
 import aiohttp
 import asyncio
 from datetime import datetime, timedelta
-from io import StringIO
-
-LOGIN_ENDPOINT = '/api/login'
-GET_LOGS_ENDPOINT = '/api/get_historical_logs'
+from io import BytesIO
+import csv
+import gzip
+
+import rcon
+import backfill
+import killstore
+from stats import KillTable, WeaponSketch
+
+API_PATH = '/api/'
+LOGS_TIMEOUT = aiohttp.ClientTimeout(total=300) # Two weeks of logs take a while to download
+SYNC_INTERVAL = 5 # Minutes between two syncs of the kill store
+FULL_RESULTS_FORMAT = 'txt' # Either 'txt' for a readable table or 'csv'
+FULL_RESULTS_GZIP = False # Whether to gzip the full results
+GZIP_MARGIN = 64 * 1024 # Bytes gzip may still be holding on to, kept free when splitting compressed files
+WEAPON_SKETCH_SLOTS = None # Weapons tracked per player when counting the raw logs in fixed memory, None to read exact counts from the kill store
 
 with open('creds.txt', 'r') as f:
     USERNAME, PASSWORD = f.read().split('\n')
@@ -33,6 +45,73 @@ def last_update():
     return dt
 
 
+class ResultsWriter:
+    """Writes text into one or more in-memory attachments as it comes in. A
+    new file, starting with the header again, is started whenever the next
+    line would push the current one over the size limit."""
+
+    def __init__(self, filename, header, limit, compress=False):
+        self.filename = filename
+        self.header = header.encode()
+        self.limit = limit - (min(GZIP_MARGIN, limit // 4) if compress else 0)
+        self.compress = compress
+        self.files = list()
+        self._open()
+
+    def _open(self):
+        self.buffer = BytesIO()
+        self.stream = gzip.GzipFile(fileobj=self.buffer, mode='wb') if self.compress else self.buffer
+        self.stream.write(self.header)
+        self.empty = True
+
+    def _close(self):
+        if self.compress: self.stream.close()
+        self.buffer.seek(0)
+        self.files.append(self.buffer)
+
+    def write(self, text):
+        data = text.encode()
+        if not self.empty and self.buffer.tell() + len(data) > self.limit:
+            self._close()
+            self._open()
+        self.stream.write(data)
+        self.empty = False
+
+    def close(self):
+        """Returns the attachments as discord Files."""
+        self._close()
+        name, ext = self.filename.rsplit('.', 1)
+        if self.compress: ext += '.gz'
+        if len(self.files) == 1:
+            return [discord.File(self.files[0], f"{name}.{ext}")]
+        return [discord.File(f, f"{name}_{i+1}.{ext}") for i, f in enumerate(self.files)]
+
+
+def write_full_results(ranking, limit, fmt=FULL_RESULTS_FORMAT, compress=FULL_RESULTS_GZIP, estimated=False):
+    """Write the ranking, with the error of each row's weapon kills at the
+    end, row by row into attachments of at most limit bytes. The errors are
+    only written when estimated."""
+    if fmt == 'csv':
+        columns = ['rank', 'name', 'kills', 'deaths', 'kd', 'weapon', 'weapon_kills']
+        if estimated: columns.append('weapon_kills_error')
+        header = ','.join(columns) + '\r\n'
+        writer = ResultsWriter('full_results.csv', header, limit, compress)
+        rows = csv.writer(writer)
+        for row in ranking:
+            rows.writerow(row if estimated else row[:-1])
+
+    else:
+        header = "RANK   NAME                      KILLS  DEATHS K/D    WEAPON"
+        if estimated:
+            header = "Weapon kills are estimated and may be too high by the amount after the ±\n\n" + header
+        writer = ResultsWriter('full_results.txt', header, limit, compress)
+        for rank, name, kills, deaths, kd, weapon, weapon_kills, error in ranking:
+            if estimated: weapon_kills = f"{weapon_kills}±{error}"
+            writer.write("\n#{: <5} {: <25} {: <6} {: <6} {: <6} {}({})".format(rank, name, kills, deaths, kd, weapon, weapon_kills))
+
+    return writer.close()
+
+
 class LeaderboardInstance:
     @classmethod
     async def create(cls, bot, url, guild_id, channel_id, name, content, show_full_results=True):
@@ -48,61 +127,63 @@ class LeaderboardInstance:
 
         return self
 
+    async def sync(self):
+        """Store the kills that happened since the last sync."""
+        session = rcon.get_session(self.url+API_PATH, USERNAME, PASSWORD)
+        return await killstore.sync(session, self.url+API_PATH, last_update(), timeout=LOGS_TIMEOUT)
+
+    async def stream_stats(self, weapon_slots):
+        """Count the kills of this period straight from the RCON's logs, with
+        each player's favourite weapon tracked in a WeaponSketch of weapon_slots."""
+        session = rcon.get_session(self.url+API_PATH, USERNAME, PASSWORD)
+        payload = {'limit': 999999, 'log_type': 'KILL'}
+        kills = dict()
+        deaths = dict()
+        sketches = dict()
+        async for log in backfill.fetch_logs(session, 'POST', killstore.GET_LOGS_ENDPOINT, payload, last_update(), timeout=LOGS_TIMEOUT):
+            _, _, _, _, kill_type, killer, victim, weapon = killstore.parse_log(self.url+API_PATH, log)
+            if kill_type == 'KILL':
+                kills[killer] = kills.get(killer, 0) + 1
+                try: sketch = sketches[killer]
+                except KeyError: sketch = sketches[killer] = WeaponSketch(weapon_slots)
+                sketch.add(weapon)
+                deaths[victim] = deaths.get(victim, 0) + 1
+        return KillTable.from_sketches(kills, deaths, sketches)
+
     async def print(self):
-        # Get logs
-        jar = aiohttp.CookieJar(unsafe=True)
-        async with aiohttp.ClientSession(cookie_jar=jar) as session:
-            # Login
-            payload = {'username': USERNAME, 'password': PASSWORD}
-            await session.post(self.url+LOGIN_ENDPOINT, json=payload)
-            # Get logs
-            payload = {'limit': 999999, 'log_type': 'KILL', 'from': str(last_update())}
-            async with session.post(self.url+GET_LOGS_ENDPOINT, json=payload) as res:
-                logs = (await res.json())['result']
-
-        # Parse logs
-        data = dict()
-        for log in logs:
-            killer = log['player_name']
-            victim = log['player2_name']
-            try: data[killer][0] += 1
-            except KeyError: data[killer] = [1, 0, {"None": 0}]
-            try: data[victim][1] += 1
-            except KeyError: data[victim] = [0, 1, {"None": 0}]
-            # Parse weapon used
-            weapon = log['content'].split(' with ')[-1]
-            if weapon == "None": weapon = "Tank/Arty"
-            try: data[killer][2][weapon] += 1
-            except KeyError: data[killer][2][weapon] = 1
-
-        # Order logs
-        data = dict(sorted(data.items(), key=lambda item: item[1][0]*1000-item[1][1], reverse=True))
-
-        # Turn into file
-        output = "RANK   NAME                      KILLS  DEATHS K/D    WEAPON"
-        for i, (name, (kills, deaths, weapons)) in enumerate(data.items()):
-            kd = round(kills/deaths, 2) if deaths else 0.00
-            weapon = max(weapons, key=weapons.get)
-            output += "\n#{: <5} {: <25} {: <6} {: <6} {: <6} {}({})".format(i+1, name, kills, deaths, kd, weapon, weapons[weapon])
-        f = StringIO(output)
-        f.seek(0)
-        
+        data = None
+        if WEAPON_SKETCH_SLOTS:
+            try: data = await self.stream_stats(WEAPON_SKETCH_SLOTS)
+            except Exception as e: print('Failed to count kills of leaderboard %s from the logs, using the kill store: %s: %s' % (self.name, e.__class__.__name__, e))
+
+        estimated = data is not None
+        if not estimated:
+            # Catch up on the last few minutes, but don't let a hiccup stop us from publishing
+            try: await self.sync()
+            except Exception as e: print('Failed to sync kills of leaderboard %s, publishing what we have: %s: %s' % (self.name, e.__class__.__name__, e))
+
+            # Get stats from the kill store
+            data = await killstore.get_stats(self.url+API_PATH, last_update())
+
+        # Rank players
+        ranking = data.top(errors=True)
+
         # Send results over discord
         embed = discord.Embed(title=f"🏆 Leaderboard from {last_update().strftime('%b %d')} to {next_update().strftime('%b %d')} 🏆", color=discord.Color.gold())
         embed.set_author(icon_url=EMBED_ICON, name=self.name)
-        for i, (name, (kills, deaths, weapons)) in enumerate(data.items()):
-            i += 1
-            if i > 15: break
-            elif i == 1: rank = "🥇"
+        for i, name, kills, deaths, kd, weapon, weapon_kills, error in ranking[:15]:
+            if estimated: weapon_kills = f"{weapon_kills}±{error}"
+            if i == 1: rank = "🥇"
             elif i == 2: rank = "🥈"
             elif i == 3: rank = "🥉"
             else: rank = "#"+str(i)
             if i <= 6: rank = '_ _\n' + rank
-            kd = round(kills/deaths, 2) if deaths else 0.00
-            weapon = max(weapons, key=weapons.get)
-            embed.add_field(name=f"{rank} {name}", value=f"Kills: {str(kills)}\nDeaths: {str(deaths)}\nK/D Ratio: {str(kd)}\nWeapon: {weapon}({str(weapons[weapon])})")
+            embed.add_field(name=f"{rank} {name}", value=f"Kills: {str(kills)}\nDeaths: {str(deaths)}\nK/D Ratio: {str(kd)}\nWeapon: {weapon}({str(weapon_kills)})")
         await self.channel.send(content=self.content, embed=embed)
-        if self.show_full_results: await self.channel.send(file=discord.File(f, "full_results.txt"))
+        if self.show_full_results:
+            # One file per message, the size limit applies to all attachments together
+            for f in write_full_results(ranking, self.guild.filesize_limit, estimated=estimated):
+                await self.channel.send(file=f)
         
 
 
@@ -112,6 +193,9 @@ class leaderboard(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
+    async def cog_load(self):
+        await killstore.create_tables()
+
     @commands.Cog.listener()
     async def on_ready(self):
         leaderboards = [
@@ -122,9 +206,17 @@ class leaderboard(commands.Cog):
         for leaderboard in leaderboards:
             inst = await LeaderboardInstance.create(self.bot, *leaderboard)
             self.leaderboards.append(inst)
+        self.sync_kills.start()
         self.print_leaderboard.start()
 
 
+    @tasks.loop(minutes=SYNC_INTERVAL)
+    async def sync_kills(self):
+        for lb in self.leaderboards:
+            try: await lb.sync()
+            except Exception as e: print('Failed to sync kills of leaderboard %s: %s: %s' % (lb.name, e.__class__.__name__, e))
+
+
     @tasks.loop(hours=24)
     async def print_leaderboard(self):
         if datetime.now().day not in RESET_ON_DAYS:
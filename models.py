@@ -1,10 +1,93 @@
+import asyncio
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+WRITE_BATCH_DELAY = 0.05 # Seconds writes are held back for, to be committed together with others
+
+
+class Database:
+    """A single long-lived connection to an SQLite database in WAL mode.
+    Statements run on a dedicated thread, so they never block the event
+    loop, and writes that come in together are committed together."""
 
-class DBConnection:
     def __init__(self, db_name):
-        self.db = sqlite3.connect(db_name)
-    def __enter__(self):
-        return self.db.cursor()
-    def __exit__(self, type, value, traceback):
-        self.db.commit()
-        self.db.close()
\ No newline at end of file
+        self.db_name = db_name
+        self._db = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self._writes = list()
+        self._flush_task = None
+
+    def _connection(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_name, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+        return self._db
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def fetchall(self, sql, params=()):
+        await self.flush() # Make sure we read our own writes
+        return await self._run(lambda: self._connection().execute(sql, params).fetchall())
+
+    async def fetchone(self, sql, params=()):
+        await self.flush()
+        return await self._run(lambda: self._connection().execute(sql, params).fetchone())
+
+    def execute(self, sql, params=()):
+        """Queue a write. Returns a future that resolves to the number of
+        affected rows once the batch it ended up in is committed."""
+        return self._queue(False, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        """Queue a write for every set of parameters. Returns a future like
+        execute does."""
+        return self._queue(True, sql, list(seq_of_params))
+
+    def _queue(self, many, sql, params):
+        future = asyncio.get_running_loop().create_future()
+        self._writes.append((many, sql, params, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+        return future
+
+    async def _flush_later(self):
+        await asyncio.sleep(WRITE_BATCH_DELAY)
+        await self.flush()
+
+    async def flush(self):
+        if self._flush_task and self._flush_task is not asyncio.current_task():
+            self._flush_task.cancel()
+        self._flush_task = None
+        writes, self._writes = self._writes, list()
+        if not writes:
+            return
+
+        def _commit():
+            db = self._connection()
+            results = list()
+            with db:
+                for many, sql, params, future in writes:
+                    try: results.append((future, (db.executemany if many else db.execute)(sql, params).rowcount, None))
+                    except Exception as e: results.append((future, None, e))
+            return results
+
+        try:
+            results = await self._run(_commit)
+        except Exception as e:
+            results = [(future, None, e) for many, sql, params, future in writes]
+        for future, rowcount, e in results:
+            if future.done():
+                continue
+            if e: future.set_exception(e)
+            else: future.set_result(rowcount)
+
+    async def close(self):
+        await self.flush()
+        if self._db is not None:
+            await self._run(self._db.close)
+            self._db = None
+
+
+db = Database('data.db')
@@ -0,0 +1,271 @@
+import aiohttp
+import asyncio
+import codecs
+import json
+import re
+import time
+from urllib.parse import urlparse
+
+LOGIN_ENDPOINT = 'login'
+
+REQUEST_TIMEOUT = 10 # Seconds before a request to the C-RCON is given up on
+KEEPALIVE_TIMEOUT = 120 # Seconds an idle connection is kept open for reuse
+STREAM_CHUNK_SIZE = 64 * 1024 # Bytes read at a time when streaming a response
+
+BREAKER_THRESHOLD = 3 # Failed connections in a row after which a host is considered down
+BREAKER_BASE_DELAY = 60 # Seconds before a host that went down is tried again
+BREAKER_MAX_DELAY = 1800 # Max number of seconds between attempts to reach a host that is down
+
+class VerificationError(Exception):
+    pass
+class RCONError(Exception):
+    pass
+class ContentTypeError(Exception):
+    pass
+class RCONUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Keeps track of failed connections to a host. After BREAKER_THRESHOLD
+    failures in a row, requests are refused without trying until a single
+    attempt is let through, with the delay doubling after each failure."""
+
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.retry_at = 0
+
+    @property
+    def open(self):
+        return self.failures >= BREAKER_THRESHOLD
+
+    def check(self):
+        if not self.open:
+            return
+        now = time.monotonic()
+        if now < self.retry_at:
+            raise RCONUnavailable('%s could not be reached, will try again in %s seconds.' % (self.host, int(self.retry_at - now)))
+        # Let this request through as a probe, but hold off any others meanwhile
+        self.retry_at = now + REQUEST_TIMEOUT
+
+    def record_success(self):
+        self.failures = 0
+        self.retry_at = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.open:
+            delay = min(BREAKER_BASE_DELAY * 2**(self.failures - BREAKER_THRESHOLD), BREAKER_MAX_DELAY)
+            self.retry_at = time.monotonic() + delay
+
+
+class _ArrayDecoder:
+    """Incrementally decodes a JSON object, yielding the items of the array
+    under `key` as soon as they are complete. Everything else is kept and
+    returned by close()."""
+
+    _WHITESPACE = ' \t\n\r'
+
+    def __init__(self, key):
+        self._key = re.compile(r'"%s"\s*:\s*' % re.escape(key))
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._head = None
+        self._tail = None
+        self._in_array = False
+
+    def feed(self, chunk):
+        self._buffer += self._utf8.decode(chunk)
+        items = list()
+
+        if self._head is None:
+            match = self._key.search(self._buffer)
+            if not match or match.end() >= len(self._buffer):
+                return items
+            if self._buffer[match.end()] != '[':
+                # Not an array (probably null), leave it to close()
+                self._head = ''
+                return items
+            self._head = self._buffer[:match.end()] + 'null'
+            self._buffer = self._buffer[match.end()+1:]
+            self._in_array = True
+
+        pos = 0
+        while self._in_array:
+            while pos < len(self._buffer) and self._buffer[pos] in self._WHITESPACE + ',':
+                pos += 1
+            if pos >= len(self._buffer):
+                break
+            if self._buffer[pos] == ']':
+                self._in_array = False
+                self._tail = ''
+                pos += 1
+                break
+            try:
+                item, pos = self._decoder.raw_decode(self._buffer, pos)
+            except json.JSONDecodeError:
+                break # Item isn't complete yet
+            items.append(item)
+        self._buffer = self._buffer[pos:]
+        return items
+
+    def close(self):
+        self._buffer += self._utf8.decode(b'', final=True)
+        if self._in_array:
+            raise json.JSONDecodeError('Unterminated array', self._buffer, len(self._buffer))
+        if self._tail is None:
+            return json.loads(self._buffer)
+        return json.loads(self._head + self._buffer)
+
+
+class RCONSession:
+    """A long-lived connection to a Community RCON API. Logs in lazily and
+    keeps the auth cookie around until the RCON rejects it."""
+
+    def __init__(self, url, username=None, password=None):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.logged_in = False
+        self._session = None
+        self._login_lock = asyncio.Lock()
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            jar = aiohttp.CookieJar(unsafe=True)
+            timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+            connector = aiohttp.TCPConnector(keepalive_timeout=KEEPALIVE_TIMEOUT)
+            self._session = aiohttp.ClientSession(cookie_jar=jar, timeout=timeout, connector=connector)
+            self.logged_in = False
+        return self._session
+
+    def set_credentials(self, username, password):
+        if (username, password) != (self.username, self.password):
+            self.username = username
+            self.password = password
+            self.logged_in = False
+
+    async def login(self, force=False):
+        if not self.username:
+            return
+        async with self._login_lock:
+            if self.logged_in and not force:
+                return
+            self.session.cookie_jar.clear()
+            payload = {'username': self.username, 'password': self.password}
+            raw_data = await self._request('POST', LOGIN_ENDPOINT, json=payload)
+            if raw_data is None or raw_data['failed'] is True:
+                raise VerificationError('Failed to login to the RCON. Check if the username and password are correct.')
+            self.logged_in = True
+
+    async def _request(self, method, endpoint, **kwargs):
+        breaker = get_breaker(self.url)
+        breaker.check()
+        try:
+            async with self.session.request(method, self.url+endpoint, **kwargs) as res:
+                breaker.record_success()
+                if res.status in (401, 403):
+                    return None
+                raw_data = await res.json()
+        except aiohttp.ContentTypeError as e:
+            raise ContentTypeError("Webpage returned unexpected data. Likely the URL is incorrect.\n\nRaw data:\n" + str(e))
+        except asyncio.TimeoutError:
+            breaker.record_failure()
+            raise asyncio.TimeoutError('Could not resolve host within %s seconds. Check if the URL is correct and the RCON tool is running.' % REQUEST_TIMEOUT)
+        except aiohttp.ClientConnectionError:
+            breaker.record_failure()
+            raise
+        if raw_data['error']:
+            raise RCONError(raw_data['error'])
+        return raw_data
+
+    async def request(self, method, endpoint, **kwargs):
+        await self.login()
+        raw_data = await self._request(method, endpoint, **kwargs)
+        if raw_data is None:
+            # Session expired or was revoked, log in again and retry once
+            if not self.username:
+                raise VerificationError('The RCON requires you to be logged in.')
+            self.logged_in = False
+            await self.login(force=True)
+            raw_data = await self._request(method, endpoint, **kwargs)
+            if raw_data is None:
+                raise VerificationError('The RCON rejected the login. Check if the account has the required permissions.')
+        return raw_data
+
+    async def stream(self, method, endpoint, key='result', **kwargs):
+        """Like request(), but yields the items under `key` one by one while
+        the response is still being read, instead of decoding it all at once."""
+        await self.login()
+        breaker = get_breaker(self.url)
+        for attempt in range(2):
+            decoder = _ArrayDecoder(key)
+            breaker.check()
+            try:
+                async with self.session.request(method, self.url+endpoint, **kwargs) as res:
+                    breaker.record_success()
+                    if res.status in (401, 403):
+                        # Session expired or was revoked, log in again and retry once
+                        if attempt or not self.username:
+                            raise VerificationError('The RCON rejected the login. Check if the account has the required permissions.')
+                        self.logged_in = False
+                        await self.login(force=True)
+                        continue
+                    async for chunk in res.content.iter_chunked(STREAM_CHUNK_SIZE):
+                        for item in decoder.feed(chunk):
+                            yield item
+                raw_data = decoder.close()
+            except json.JSONDecodeError as e:
+                raise ContentTypeError("Webpage returned unexpected data. Likely the URL is incorrect.\n\nRaw data:\n" + str(e))
+            except asyncio.TimeoutError:
+                breaker.record_failure()
+                raise asyncio.TimeoutError('Could not resolve host within %s seconds. Check if the URL is correct and the RCON tool is running.' % REQUEST_TIMEOUT)
+            except aiohttp.ClientConnectionError:
+                breaker.record_failure()
+                raise
+            if raw_data['error']:
+                raise RCONError(raw_data['error'])
+            return
+
+    async def get(self, endpoint, **kwargs):
+        return await self.request('GET', endpoint, **kwargs)
+    async def post(self, endpoint, **kwargs):
+        return await self.request('POST', endpoint, **kwargs)
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self.logged_in = False
+
+
+_breakers = dict()
+
+def get_breaker(url):
+    """Get the circuit breaker for the host of this url, creating it if needed."""
+    host = urlparse(url).netloc
+    try:
+        breaker = _breakers[host]
+    except KeyError:
+        breaker = _breakers[host] = CircuitBreaker(host)
+    return breaker
+
+_sessions = dict()
+
+def get_session(url, username=None, password=None):
+    """Get the shared session for this url and username, creating it if needed."""
+    key = (url, username)
+    try:
+        session = _sessions[key]
+    except KeyError:
+        session = _sessions[key] = RCONSession(url, username, password)
+    else:
+        session.set_credentials(username, password)
+    return session
+
+async def close_all():
+    for session in _sessions.values():
+        await session.close()
+    _sessions.clear()
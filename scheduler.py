@@ -0,0 +1,118 @@
+import asyncio
+import itertools
+import time
+
+CHANNEL_EDIT_INTERVAL = 1.0 # Min number of seconds between two edits in the same channel
+GLOBAL_EDITS_PER_SECOND = 25 # Max number of edits sent per second in total
+
+PRIORITY_USER = 0
+PRIORITY_BACKGROUND = 1
+
+
+class _PendingEdit:
+    def __init__(self, message, priority, kwargs, seq):
+        self.message = message
+        self.priority = priority
+        self.kwargs = kwargs
+        self.seq = seq
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class EditScheduler:
+    """Sends message edits through a single queue. Only the newest pending
+    edit of a message is kept, edits are spaced out per channel and in
+    total, and user-triggered edits go before background refreshes."""
+
+    def __init__(self, channel_interval=CHANNEL_EDIT_INTERVAL, global_rate=GLOBAL_EDITS_PER_SECOND):
+        self.channel_interval = channel_interval
+        self.global_interval = 1 / global_rate
+        self._pending = dict()
+        self._channel_next = dict()
+        self._global_next = 0
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._worker = None
+        self._sending = set()
+        self.edits_sent = 0
+        self.edits_coalesced = 0
+
+    def edit(self, message, priority=PRIORITY_BACKGROUND, **kwargs):
+        """Queue an edit of the message. Returns a future that resolves to
+        True once the edit is made, or to False when a newer edit of the
+        same message replaced it first."""
+        old = self._pending.pop(message.id, None)
+        if old:
+            # A replaced user edit keeps its place in line
+            priority = min(priority, old.priority)
+            if not old.future.done(): old.future.set_result(False)
+            self.edits_coalesced += 1
+        pending = _PendingEdit(message, priority, kwargs, next(self._counter))
+        self._pending[message.id] = pending
+
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._run())
+        self._wakeup.set()
+        return pending.future
+
+    def cancel(self, message_id):
+        """Drop the pending edit of a message, if any, for example because
+        it was edited some other way. Its future resolves to False."""
+        pending = self._pending.pop(message_id, None)
+        if pending and not pending.future.done():
+            pending.future.set_result(False)
+
+    def _next_ready_at(self, pending):
+        return max(self._channel_next.get(pending.message.channel.id, 0), self._global_next)
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            # Pick the most urgent edit of those that may be sent soonest
+            now = time.monotonic()
+            pending = min(self._pending.values(), key=lambda p: (max(self._next_ready_at(p), now), p.priority, p.seq))
+            delay = self._next_ready_at(pending) - now
+            if delay > 0:
+                # Something more urgent may come in while we wait
+                self._wakeup.clear()
+                try: await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError: pass
+                continue
+
+            del self._pending[pending.message.id]
+            self._channel_next[pending.message.channel.id] = now + self.channel_interval
+            self._global_next = now + self.global_interval
+            # Keep a reference, so the task isn't garbage collected while sending
+            task = asyncio.ensure_future(self._send(pending))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, pending):
+        try:
+            await pending.message.edit(**pending.kwargs)
+        except Exception as e:
+            if not pending.future.done(): pending.future.set_exception(e)
+        else:
+            self.edits_sent += 1
+            if not pending.future.done(): pending.future.set_result(True)
+
+    def close(self):
+        """Stop sending edits. Those that are still pending resolve to False."""
+        if self._worker:
+            self._worker.cancel()
+            self._worker = None
+        for message_id in list(self._pending):
+            self.cancel(message_id)
+
+
+_scheduler = None
+
+def get_scheduler():
+    """Get the shared edit scheduler, creating it if needed."""
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = EditScheduler()
+    return _scheduler
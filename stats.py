@@ -0,0 +1,174 @@
+from array import array
+import heapq
+import sys
+
+import numpy as np
+
+
+class PlayerStats:
+    """Kills and deaths per player. Names are mapped to integer ids, which
+    index into compact arrays of counters."""
+
+    def __init__(self):
+        self._ids = dict()
+        self.names = list()
+        self.kills = array('I')
+        self.deaths = array('I')
+
+    def __len__(self):
+        return len(self.names)
+
+    def player_id(self, name):
+        try:
+            return self._ids[name]
+        except KeyError:
+            name = sys.intern(name)
+            player_id = self._ids[name] = len(self.names)
+            self.names.append(name)
+            self.kills.append(0)
+            self.deaths.append(0)
+            return player_id
+
+    def add_kill(self, name):
+        self.kills[self.player_id(name)] += 1
+    def add_death(self, name):
+        self.deaths[self.player_id(name)] += 1
+
+    def score(self, player_id):
+        return self.kills[player_id]*1000 - self.deaths[player_id]
+
+    def top(self, start, stop):
+        """Returns (rank, name, kills, deaths) for the players ranked start+1
+        up to and including stop, without sorting all other players."""
+        ids = heapq.nlargest(stop, range(len(self.names)), key=self.score)[start:]
+        return [(start+i+1, self.names[player_id], self.kills[player_id], self.deaths[player_id])
+            for i, player_id in enumerate(ids)]
+
+    def copy(self):
+        other = PlayerStats()
+        other._ids = self._ids.copy()
+        other.names = self.names.copy()
+        other.kills = array('I', self.kills)
+        other.deaths = array('I', self.deaths)
+        return other
+
+
+class WeaponSketch:
+    """Space-Saving sketch of the weapons a player killed with. Keeps at most
+    `slots` counters, so the favourite weapon is found in fixed memory. A
+    reported count may be too high by at most its error, never too low."""
+    __slots__ = ('slots', 'counts', 'errors')
+
+    def __init__(self, slots):
+        self.slots = slots
+        self.counts = dict()
+        self.errors = dict()
+
+    def add(self, weapon, kills=1):
+        if weapon in self.counts:
+            self.counts[weapon] += kills
+        elif len(self.counts) < self.slots:
+            self.counts[weapon] = kills
+            self.errors[weapon] = 0
+        else:
+            # Evict the smallest counter, its count becomes the new one's error
+            evicted = min(self.counts, key=self.counts.get)
+            floor = self.counts.pop(evicted)
+            del self.errors[evicted]
+            self.counts[weapon] = floor + kills
+            self.errors[weapon] = floor
+
+    def top(self):
+        """Returns (weapon, count, error) of the most used weapon."""
+        weapon = max(self.counts, key=lambda weapon: (self.counts[weapon], -self.errors[weapon]))
+        return weapon, self.counts[weapon], self.errors[weapon]
+
+
+class KillTable:
+    """Kills, deaths and favourite weapon per player, as columns. Players and
+    weapons are integer-coded so that everything is counted in bulk."""
+
+    def __init__(self, names, kills, deaths, weapons, top_weapon, top_weapon_kills, top_weapon_error=None):
+        self.names = names
+        self.kills = kills
+        self.deaths = deaths
+        self.weapons = weapons
+        self.top_weapon = top_weapon
+        self.top_weapon_kills = top_weapon_kills
+        self.top_weapon_error = np.zeros(len(names), dtype=np.int64) if top_weapon_error is None else top_weapon_error
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_counts(cls, players, weapons, kills, deaths):
+        """Build a table from rows of (player, weapon, kills, deaths), given
+        as four columns. A player may appear in any number of rows."""
+        names, player_codes = np.unique(np.asarray(players, dtype=object), return_inverse=True)
+        weapon_names, weapon_codes = np.unique(np.asarray(weapons, dtype=object), return_inverse=True)
+        kills = np.asarray(kills, dtype=np.int64)
+        deaths = np.asarray(deaths, dtype=np.int64)
+        if not len(names):
+            return cls(names, kills, deaths, np.array(["None"], dtype=object), np.zeros(0, dtype=np.int64), kills)
+
+        total_kills = np.bincount(player_codes, weights=kills, minlength=len(names)).astype(np.int64)
+        total_deaths = np.bincount(player_codes, weights=deaths, minlength=len(names)).astype(np.int64)
+
+        # Players without kills get "None" as their weapon, which is appended last
+        weapon_names = np.append(weapon_names, "None")
+        top_weapon = np.full(len(names), len(weapon_names) - 1)
+        top_weapon_kills = np.zeros(len(names), dtype=np.int64)
+
+        # Sort by player, then kills with the weapon, and take the first row of each player
+        mask = kills > 0
+        order = np.lexsort((weapon_codes[mask], -kills[mask], player_codes[mask]))
+        sorted_players = player_codes[mask][order]
+        players_with_kills, first = np.unique(sorted_players, return_index=True)
+        top_weapon[players_with_kills] = weapon_codes[mask][order][first]
+        top_weapon_kills[players_with_kills] = kills[mask][order][first]
+
+        return cls(names, total_kills, total_deaths, weapon_names, top_weapon, top_weapon_kills)
+
+    @classmethod
+    def from_sketches(cls, kills, deaths, sketches):
+        """Build a table from dicts mapping players to their kills, deaths and
+        WeaponSketch. Favourite weapon kills may be too high by their error."""
+        names = np.array(sorted(set(kills) | set(deaths)), dtype=object)
+        weapon_names = ["None"]
+        weapon_codes = {"None": 0}
+        top_weapon = np.zeros(len(names), dtype=np.int64)
+        top_weapon_kills = np.zeros(len(names), dtype=np.int64)
+        top_weapon_error = np.zeros(len(names), dtype=np.int64)
+        for player_id, name in enumerate(names):
+            if name not in sketches:
+                continue
+            weapon, top_weapon_kills[player_id], top_weapon_error[player_id] = sketches[name].top()
+            if weapon not in weapon_codes:
+                weapon_codes[weapon] = len(weapon_names)
+                weapon_names.append(weapon)
+            top_weapon[player_id] = weapon_codes[weapon]
+
+        return cls(names, np.array([kills.get(name, 0) for name in names], dtype=np.int64),
+            np.array([deaths.get(name, 0) for name in names], dtype=np.int64),
+            np.array(weapon_names, dtype=object), top_weapon, top_weapon_kills, top_weapon_error)
+
+    @property
+    def kd(self):
+        """K/D ratio per player, 0 for players that never died."""
+        return np.round(np.divide(self.kills, self.deaths, out=np.zeros(len(self.kills)), where=self.deaths > 0), 2)
+
+    def ranking(self):
+        """Player indexes ordered from best to worst."""
+        return np.argsort(-(self.kills*1000 - self.deaths), kind='stable')
+
+    def top(self, start=0, stop=None, errors=False):
+        """Returns (rank, name, kills, deaths, kd, weapon, weapon kills) for
+        the players ranked start+1 up to and including stop. With errors, the
+        amount weapon kills may be overestimated by is added at the end."""
+        kd = self.kd
+        ids = self.ranking()[start:stop]
+        rows = [(start+i+1, self.names[player_id], int(self.kills[player_id]), int(self.deaths[player_id]), float(kd[player_id]),
+            self.weapons[self.top_weapon[player_id]], int(self.top_weapon_kills[player_id])) for i, player_id in enumerate(ids)]
+        if errors:
+            rows = [row + (int(self.top_weapon_error[player_id]),) for row, player_id in zip(rows, ids)]
+        return rows